@@ -0,0 +1,322 @@
+"""
+This module holds rows in a compact columnar buffer instead of a list of tuples.
+Numeric columns are stored in typed arrays and text columns as integer codes that point
+to a single copy of each distinct string, so a row costs a few dozen bytes.
+"""
+
+import os
+import subprocess
+import sys
+from array import array
+
+
+# Array type codes for each column type, see store.COLUMN_TYPES. Salaries and hours fit in 32 bits.
+TYPE_CODES = {"INTEGER": "i", "REAL": "d", "TEXT": "I"}
+
+
+class ColumnBuffer:
+    """A columnar buffer of rows with interned text columns.
+
+    Parameters
+    ----------
+    columns : list
+        The column names.
+
+    types : list
+        The type of each column: INTEGER, REAL or TEXT.
+
+    """
+
+    __slots__ = ["columns", "types", "arrays", "values", "codes"]
+
+    def __init__(self, columns, types):
+
+        self.columns = list(columns)
+        self.types = list(types)
+        self.clear()
+
+    def __len__(self):
+
+        return len(self.arrays[0])
+
+    def append(self, row):
+        """Appends a row.
+
+        Parameters
+        ----------
+        row : tuple
+            The values in the same order as the columns.
+
+        """
+
+        for position, value in enumerate(row):
+
+            codes = self.codes[position]
+
+            if codes is not None:
+                code = codes.get(value)
+
+                if code is None:
+                    code = codes[value] = len(self.values[position])
+                    self.values[position].append(value)
+
+                value = code
+
+            self.arrays[position].append(value)
+
+    def row(self, index):
+        """Gets a row.
+
+        Parameters
+        ----------
+        index : int
+            The position of the row.
+
+        Returns
+        -------
+        tuple
+            The values in the same order as the columns.
+
+        """
+
+        return tuple(values[column[index]] if values is not None else column[index]
+                     for column, values in zip(self.arrays, self.values))
+
+    def rows(self):
+        """Iterates over the rows.
+
+        Returns
+        -------
+        generator
+            The rows as tuples.
+
+        """
+
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def column(self, name):
+        """Gets the values of a column.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        Returns
+        -------
+        list
+            The decoded values.
+
+        """
+
+        position = self.columns.index(name)
+        values = self.values[position]
+
+        if values is None:
+            return self.arrays[position].tolist()
+
+        return [values[code] for code in self.arrays[position]]
+
+    def distinct_values(self, name):
+        """Gets the distinct values of a text column, the position of each value is its code.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        Returns
+        -------
+        list
+            The distinct values, it is not copied.
+
+        """
+
+        return self.values[self.columns.index(name)]
+
+    def encoded(self, name):
+        """Gets the codes of a text column or the values of a numeric one, without decoding them.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        Returns
+        -------
+        array.array
+            The value of each row, it is not copied.
+
+        """
+
+        return self.arrays[self.columns.index(name)]
+
+    def code(self, name, value):
+        """Gets the code of a value of a text column.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        value : str
+            The value.
+
+        Returns
+        -------
+        int
+            The code, None if no row has the value.
+
+        """
+
+        return self.codes[self.columns.index(name)].get(value)
+
+    def extend_encoded(self, name, values, codes):
+        """Appends already encoded rows to a text column, like the ones saved from
+        distinct_values() and encoded(). It must be called for every column of an empty buffer.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        values : list
+            The distinct values of the rows.
+
+        codes : list
+            The code of each row, the position of its value in values.
+
+        """
+
+        position = self.columns.index(name)
+
+        self.values[position].extend(values)
+        self.codes[position].update((value, code) for code, value in enumerate(values))
+        self.arrays[position].extend(codes)
+
+    def clear(self):
+        """Removes the rows and their distinct text values, so a reused buffer doesn't grow."""
+
+        self.arrays = [array(TYPE_CODES[column_type]) for column_type in self.types]
+
+        # For each text column, the distinct values and their codes.
+        self.values = [list() if column_type == "TEXT" else None for column_type in self.types]
+        self.codes = [dict() if column_type == "TEXT" else None for column_type in self.types]
+
+
+def measure_peak_memory(layout, source, count):
+    """Loads rows into a list of tuples or a ColumnBuffer and prints the peak RSS in MB.
+    It is meant to run in its own process, see benchmark().
+
+    Parameters
+    ----------
+    layout : str
+        Either tuples, columns or batches.
+
+    source : str
+        Either sample, for the shipped dataset, or synthetic.
+
+    count : int
+        The number of synthetic rows.
+
+    """
+
+    import resource
+
+    import store
+
+    # step2 is imported before the baseline, so its modules don't count as growth.
+    import step2
+
+    if source == "sample":
+        # Read lazily, so only the layout holds the rows.
+        rows = store.read_rows()
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        total = load_rows(layout, rows, step2.BATCH_SIZE)
+    else:
+        import dedup
+
+        rows = (row + ("",) for _, row in dedup.synthetic_rows(count))
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        total = load_rows(layout, rows, step2.BATCH_SIZE)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes.
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    print("{} {} {:.1f} {:.1f}".format(total, layout, peak / divisor,
+                                       (peak - baseline) / divisor))
+
+
+def load_rows(layout, rows, batch_size):
+    """Holds the rows in memory using the specified layout.
+
+    Parameters
+    ----------
+    layout : str
+        tuples or columns to hold every row, batches to clear a ColumnBuffer
+        every batch_size rows like step2.main() does.
+
+    rows : iterable
+        Rows in the same order as store.COLUMNS.
+
+    batch_size : int
+        The number of rows of each batch.
+
+    Returns
+    -------
+    int
+        The number of rows loaded.
+
+    """
+
+    import store
+
+    if layout == "tuples":
+        return len(list(rows))
+
+    buffer = ColumnBuffer(store.COLUMNS, store.COLUMN_TYPES.values())
+    total = 0
+
+    for row in rows:
+        buffer.append(row)
+        total += 1
+
+        if layout == "batches" and len(buffer) == batch_size:
+            buffer.clear()
+
+    return total
+
+
+def benchmark(count=1000000):
+    """Compares the peak RSS of a list of tuples, a ColumnBuffer and a ColumnBuffer cleared
+    after every batch, each one in a new process.
+
+    Parameters
+    ----------
+    count : int
+        The number of synthetic rows.
+
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    print("| Rows | Layout | Peak RSS (MB) | Growth (MB) |")
+    print("|---:|---|---:|---:|")
+
+    for source in ["sample", "synthetic"]:
+        for layout in ["tuples", "columns", "batches"]:
+
+            code = "import columns; columns.measure_peak_memory({!r}, {!r}, {})".format(
+                layout, source, count)
+            result = subprocess.run([sys.executable, "-c", code], cwd=folder,
+                                    capture_output=True, text=True, check=True)
+
+            rows, layout, peak, growth = result.stdout.split()
+            print("| {:,} | {} | {} | {} |".format(int(rows), layout, peak, growth))
+
+
+if __name__ == "__main__":
+
+    benchmark()
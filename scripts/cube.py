@@ -0,0 +1,505 @@
+"""
+This module maintains a rollup cube of the job offers, so the figures can be generated
+from pre-aggregated values instead of scanning every row.
+
+Every aggregate holds the number of offers, the sum of their salaries and a sparse
+histogram of the exact salaries, so counts, means and medians are exact.
+The cells are keyed by (date, state, education level, experience) and answer filtered
+questions. The rollups are keyed by a single dimension and answer the figures, their
+size doesn't grow with the number of rows, only with the number of distinct values.
+"""
+
+import json
+import os
+import time
+from datetime import date
+
+import store
+
+
+CUBE_FILE = "./cube.json"
+
+CELL_DIMENSIONS = ["isodate", "state", "education_level", "experience"]
+ROLLUP_DIMENSIONS = CELL_DIMENSIONS + ["weekday", "days_worked", "hours_worked"]
+
+# The rollups that can be rebuilt from the cells, the cells don't have the days and hours worked.
+CELL_ROLLUPS = CELL_DIMENSIONS + ["weekday"]
+
+# Positions of the cube columns in a step2 row.
+ROW_POSITIONS = {"isodate": 0, "salary": 2, "hours_worked": 6, "days_worked": 14,
+                 "state": 15, "education_level": 17, "experience": 18, "duplicate_of": 20}
+
+
+def create_cube():
+    """Creates an empty cube.
+
+    Returns
+    -------
+    dict
+        The cells and a rollup for each dimension.
+
+    """
+
+    return {"cells": dict(), "rollups": {dimension: dict() for dimension in ROLLUP_DIMENSIONS}}
+
+
+def load_cube(cube_file=CUBE_FILE):
+    """Loads the cube from disk, an empty cube is returned if the file doesn't exist.
+
+    Parameters
+    ----------
+    cube_file : str
+        The path of the cube file.
+
+    Returns
+    -------
+    dict
+        The cube.
+
+    """
+
+    cube = create_cube()
+
+    if not os.path.exists(cube_file):
+        return cube
+
+    with open(cube_file, "r", encoding="utf-8") as temp_file:
+        saved = json.load(temp_file)
+
+    # JSON has no tuple keys and its object keys are strings, so the aggregates
+    # are saved as lists of [key, count, salary sum, histogram pairs].
+    for key, count, salary_sum, histogram in saved["cells"]:
+        cube["cells"][tuple(key)] = [count, salary_sum, dict(histogram)]
+
+    for dimension in ROLLUP_DIMENSIONS:
+        for key, count, salary_sum, histogram in saved["rollups"][dimension]:
+            cube["rollups"][dimension][key] = [count, salary_sum, dict(histogram)]
+
+    return cube
+
+
+def save_cube(cube, cube_file=CUBE_FILE):
+    """Saves the cube to disk.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    cube_file : str
+        The path of the cube file.
+
+    """
+
+    def to_lists(aggregates):
+        return [[list(key) if isinstance(key, tuple) else key, count, salary_sum,
+                 list(histogram.items())]
+                for key, (count, salary_sum, histogram) in aggregates.items()]
+
+    saved = {"cells": to_lists(cube["cells"]),
+             "rollups": {dimension: to_lists(cube["rollups"][dimension])
+                         for dimension in ROLLUP_DIMENSIONS}}
+
+    with open(cube_file, "w", encoding="utf-8") as temp_file:
+        json.dump(saved, temp_file, ensure_ascii=False)
+
+
+def add_to(aggregates, key, salary):
+    """Adds an offer to the aggregate of the key, creating it if needed.
+
+    Parameters
+    ----------
+    aggregates : dict
+        The cells or a rollup.
+
+    key : object
+        The key of the aggregate.
+
+    salary : int
+        The salary of the offer.
+
+    """
+
+    aggregate = aggregates.get(key)
+
+    if aggregate is None:
+        aggregate = aggregates[key] = [0, 0, dict()]
+
+    aggregate[0] += 1
+    aggregate[1] += salary
+    aggregate[2][salary] = aggregate[2].get(salary, 0) + 1
+
+
+def update_cube(cube, rows):
+    """Adds new rows to the cube, flagged reposts are left out.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    rows : iterable
+        Rows in the same order as step2.COLUMNS, values can be strings like in the .csv file.
+
+    """
+
+    rollups = cube["rollups"]
+    weekdays = dict()
+
+    for row in rows:
+
+        if row[ROW_POSITIONS["duplicate_of"]]:
+            continue
+
+        salary = int(row[ROW_POSITIONS["salary"]])
+        isodate = row[ROW_POSITIONS["isodate"]]
+
+        if isodate not in weekdays:
+            weekdays[isodate] = date.fromisoformat(isodate).weekday()
+
+        values = {"isodate": isodate,
+                  "weekday": weekdays[isodate],
+                  "state": row[ROW_POSITIONS["state"]],
+                  "education_level": row[ROW_POSITIONS["education_level"]],
+                  "experience": row[ROW_POSITIONS["experience"]],
+                  "days_worked": int(row[ROW_POSITIONS["days_worked"]]),
+                  "hours_worked": float(row[ROW_POSITIONS["hours_worked"]])}
+
+        add_to(cube["cells"], tuple(values[dimension]
+                                    for dimension in CELL_DIMENSIONS), salary)
+
+        for dimension in ROLLUP_DIMENSIONS:
+            add_to(rollups[dimension], values[dimension], salary)
+
+
+def merge(aggregates):
+    """Merges several aggregates into one.
+
+    Parameters
+    ----------
+    aggregates : iterable
+        The [count, salary sum, histogram] aggregates.
+
+    Returns
+    -------
+    list
+        The merged aggregate.
+
+    """
+
+    merged = [0, 0, dict()]
+
+    for count, salary_sum, histogram in aggregates:
+        merged[0] += count
+        merged[1] += salary_sum
+
+        for salary, total in histogram.items():
+            merged[2][salary] = merged[2].get(salary, 0) + total
+
+    return merged
+
+
+def group_by(cube, dimension, **filters):
+    """Gets the aggregate of each value of a dimension.
+    Without filters the rollups are used, with filters the cells are scanned.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    dimension : str
+        One of ROLLUP_DIMENSIONS, only CELL_DIMENSIONS and weekday with filters.
+
+    filters : str
+        Values of CELL_DIMENSIONS the cells must match.
+
+    Returns
+    -------
+    dict
+        The [count, salary sum, histogram] aggregate of each value.
+
+    """
+
+    if not filters:
+        return cube["rollups"][dimension]
+
+    groups = dict()
+    positions = {name: CELL_DIMENSIONS.index(name) for name in filters}
+
+    for key, aggregate in cube["cells"].items():
+
+        if any(key[position] != filters[name] for name, position in positions.items()):
+            continue
+
+        if dimension == "weekday":
+            value = date.fromisoformat(key[0]).weekday()
+        else:
+            value = key[CELL_DIMENSIONS.index(dimension)]
+
+        groups.setdefault(value, []).append(aggregate)
+
+    return {value: merge(aggregates) for value, aggregates in groups.items()}
+
+
+def filter_cube(cube, start_date=None, end_date=None, states=None):
+    """Gets a cube with only the cells that match the filters, its rollups are rebuilt
+    from them. Only the CELL_ROLLUPS can be rebuilt, the other rollups are left out.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    states : list
+        The states to include, all of them by default.
+
+    Returns
+    -------
+    dict
+        The filtered cube.
+
+    """
+
+    filtered = {"cells": dict(), "rollups": {dimension: dict() for dimension in CELL_ROLLUPS}}
+    weekdays = dict()
+
+    for key, aggregate in cube["cells"].items():
+
+        isodate, state = key[0], key[1]
+
+        if start_date is not None and isodate < start_date:
+            continue
+
+        if end_date is not None and isodate > end_date:
+            continue
+
+        if states is not None and state not in states:
+            continue
+
+        filtered["cells"][key] = aggregate
+
+        if isodate not in weekdays:
+            weekdays[isodate] = date.fromisoformat(isodate).weekday()
+
+        values = dict(zip(CELL_DIMENSIONS, key), weekday=weekdays[isodate])
+
+        for dimension in CELL_ROLLUPS:
+            filtered["rollups"][dimension].setdefault(values[dimension], []).append(aggregate)
+
+    for dimension in CELL_ROLLUPS:
+        filtered["rollups"][dimension] = {value: merge(aggregates) for value, aggregates
+                                          in filtered["rollups"][dimension].items()}
+
+    return filtered
+
+
+def counts_by(cube, dimension, **filters):
+    """Counts the offers by the values of a dimension.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    dimension : str
+        See group_by().
+
+    filters : str
+        See group_by().
+
+    Returns
+    -------
+    dict
+        The number of offers for each value.
+
+    """
+
+    return {value: aggregate[0] for value, aggregate in group_by(cube, dimension, **filters).items()}
+
+
+def median_salary_by(cube, dimension, **filters):
+    """Gets the median salary for each value of a dimension.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    dimension : str
+        See group_by().
+
+    filters : str
+        See group_by().
+
+    Returns
+    -------
+    dict
+        The median salary for each value.
+
+    """
+
+    return {value: histogram_quantile(aggregate[2], 0.5)
+            for value, aggregate in group_by(cube, dimension, **filters).items()}
+
+
+def salary_histogram(cube):
+    """Gets the number of offers for each salary.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    Returns
+    -------
+    dict
+        The number of offers for each salary.
+
+    """
+
+    # Every offer is in exactly one value of any rollup, the state one is the smallest.
+    return merge(cube["rollups"]["state"].values())[2]
+
+
+def histogram_quantile(histogram, quantile):
+    """Gets a quantile of the salaries in a histogram, interpolated like pandas does.
+
+    Parameters
+    ----------
+    histogram : dict
+        The number of offers for each salary.
+
+    quantile : float
+        The quantile, between 0 and 1.
+
+    Returns
+    -------
+    float
+        The salary at the quantile, None if the histogram is empty.
+
+    """
+
+    total = sum(histogram.values())
+
+    if total == 0:
+        return None
+
+    position = (total - 1) * quantile
+    lower_index = int(position)
+    upper_index = min(lower_index + 1, total - 1)
+    lower_value = None
+    seen = 0
+
+    for salary in sorted(histogram):
+
+        seen += histogram[salary]
+
+        if lower_value is None and seen > lower_index:
+            lower_value = salary
+
+        if seen > upper_index:
+            return lower_value + (salary - lower_value) * (position - lower_index)
+
+
+def salary_summary(cube):
+    """Gets the same statistics as pandas describe() for the salaries.
+
+    Parameters
+    ----------
+    cube : dict
+        The cube.
+
+    Returns
+    -------
+    dict
+        The count, mean, minimum, quartiles and maximum.
+
+    """
+
+    count, salary_sum, histogram = merge(cube["rollups"]["state"].values())
+
+    if count == 0:
+        return {"count": 0}
+
+    summary = {"count": count, "mean": salary_sum / count}
+
+    for name, quantile in [("min", 0), ("25%", 0.25), ("50%", 0.5), ("75%", 0.75), ("max", 1)]:
+        summary[name] = histogram_quantile(histogram, quantile)
+
+    return summary
+
+
+def build_from_csv(csv_file="data.csv"):
+    """Builds a cube from an existing .csv file produced by step2.
+
+    Parameters
+    ----------
+    csv_file : str
+        The path of the .csv file.
+
+    Returns
+    -------
+    dict
+        The cube.
+
+    """
+
+    cube = create_cube()
+    update_cube(cube, store.read_rows(csv_file))
+
+    return cube
+
+
+def benchmark(csv_file=store.SAMPLE_FILE, scales=(1, 10, 100)):
+    """Measures the time to answer every figure query from the cube as the history grows.
+
+    Parameters
+    ----------
+    csv_file : str
+        The listings of one month, see store.simulate_history().
+
+    scales : tuple
+        The number of months in each history.
+
+    """
+
+    seed_rows = list(store.read_rows(csv_file))
+
+    print("| Rows | Cells | Update (s) | All figure queries (ms) |")
+    print("|---:|---:|---:|---:|")
+
+    for scale in scales:
+
+        cube = create_cube()
+        start_time = time.perf_counter()
+
+        update_cube(cube, store.simulate_history(seed_rows, scale))
+
+        update_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+
+        for dimension in ["isodate", "weekday", "state", "education_level", "experience",
+                          "days_worked", "hours_worked"]:
+            counts_by(cube, dimension)
+
+        median_salary_by(cube, "state")
+        salary_histogram(cube)
+        salary_summary(cube)
+
+        query_seconds = time.perf_counter() - start_time
+
+        print("| {:,} | {:,} | {:.2f} | {:.1f} |".format(
+            len(seed_rows) * scale, len(cube["cells"]), update_seconds, query_seconds * 1000))
+
+
+if __name__ == "__main__":
+
+    benchmark()
@@ -0,0 +1,443 @@
+"""
+This module detects duplicated and reposted job listings.
+Each listing gets an exact fingerprint of all its fields and a 64 bit simhash of its
+title. A near duplicate must also have a close salary and the same value in every other field.
+The fingerprints are kept in an index saved to disk.
+"""
+
+import hashlib
+import json
+import os
+import random
+import time
+
+import metrics
+
+
+FINGERPRINTS_FILE = "./fingerprints.json"
+
+# Two simhashes are near duplicates if they differ in at most this number of bits.
+# The 64 bits are split into MAX_DISTANCE + 1 bands, two near duplicates always share one.
+MAX_DISTANCE = 3
+BANDS = MAX_DISTANCE + 1
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+# A near duplicate can't differ by more than this in its salary.
+SALARY_ROUNDING = 500
+
+
+def create_index():
+    """Creates an empty fingerprints index.
+
+    Returns
+    -------
+    dict
+        The exact hashes, the (simhash, block, salary) of each listing
+        and the bands used to look them up.
+
+    """
+
+    return {"exact": dict(), "simhashes": dict(), "bands": [dict() for _ in range(BANDS)]}
+
+
+def load_index():
+    """Loads the fingerprints index from disk.
+
+    Returns
+    -------
+    dict
+        The fingerprints index.
+
+    """
+
+    index = create_index()
+
+    if not os.path.exists(FINGERPRINTS_FILE):
+        return index
+
+    with open(FINGERPRINTS_FILE, "r", encoding="utf-8") as temp_file:
+        saved = json.load(temp_file)
+
+    # Older files hashed the salary and location into the simhash, they can't be compared.
+    if saved["simhashes"] and not isinstance(next(iter(saved["simhashes"].values())), list):
+        print("Outdated fingerprints, they are rebuilt by step2.py:", FINGERPRINTS_FILE)
+        return index
+
+    index["exact"] = saved["exact"]
+
+    # The bands are not saved, they are rebuilt from the simhashes.
+    for listing_id, (simhash, block, salary) in saved["simhashes"].items():
+        add_simhash(index, listing_id, int(simhash, 16), block, salary)
+
+    return index
+
+
+def save_index(index):
+    """Saves the fingerprints index to disk.
+
+    Parameters
+    ----------
+    index : dict
+        The fingerprints index.
+
+    """
+
+    saved = {"exact": index["exact"],
+             "simhashes": {listing_id: [format(simhash, "016x"), block, salary]
+                           for listing_id, (simhash, block, salary)
+                           in index["simhashes"].items()}}
+
+    with open(FINGERPRINTS_FILE, "w", encoding="utf-8") as temp_file:
+        json.dump(saved, temp_file, ensure_ascii=False)
+
+
+def normalize(value):
+    """Normalizes a field so cosmetic differences don't change the fingerprint.
+
+    Parameters
+    ----------
+    value : object
+        The field value.
+
+    Returns
+    -------
+    str
+        The lowercase value with the whitespace collapsed.
+
+    """
+
+    return " ".join(str(value).lower().split())
+
+
+def exact_hash(row):
+    """Hashes every field of the row except the date.
+
+    Parameters
+    ----------
+    row : tuple
+        A row as returned by step2.parse_html().
+
+    Returns
+    -------
+    str
+        The hexadecimal digest.
+
+    """
+
+    # The fields are joined first so the whole block is normalized in one pass.
+    block = normalize("|".join(map(str, row[1:])))
+
+    return hashlib.blake2b(block.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def block_key(row):
+    """Gets the fields a repost keeps: the contract, schedule, location and requirements.
+    Only the title and the salary of a near duplicate can differ.
+
+    Parameters
+    ----------
+    row : tuple
+        A row as returned by step2.parse_html().
+
+    Returns
+    -------
+    str
+        The hexadecimal digest of the normalized fields.
+
+    """
+
+    block = normalize("|".join(map(str, row[3:])))
+
+    return hashlib.blake2b(block.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def simhash(row):
+    """Computes a 64 bit simhash of the title of the row.
+
+    Parameters
+    ----------
+    row : tuple
+        A row as returned by step2.parse_html().
+
+    Returns
+    -------
+    int
+        The simhash.
+
+    """
+
+    title = normalize(row[1])
+
+    # Short titles give few words, the character trigrams keep the simhash bits balanced.
+    features = title.split()
+    features.extend(title[position:position + 3] for position in range(len(title) - 2))
+
+    # Bit sliced counters, counters[b] holds the bit b of the count of every position.
+    counters = list()
+
+    for feature in features:
+        carry = int.from_bytes(hashlib.blake2b(
+            feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+        for position, counter in enumerate(counters):
+            counters[position], carry = counter ^ carry, counter & carry
+
+            if not carry:
+                break
+
+        if carry:
+            counters.append(carry)
+
+    # A bit is set when more than half of the features have it set.
+    threshold = len(features) // 2
+    greater = 0
+    equal = (1 << 64) - 1
+
+    for position in range(len(counters) - 1, -1, -1):
+
+        if threshold >> position & 1:
+            equal &= counters[position]
+        else:
+            greater |= equal & counters[position]
+            equal &= ~counters[position]
+
+    # The threshold may have more bits than the counters.
+    if threshold >> len(counters):
+        return 0
+
+    return greater
+
+
+def add_simhash(index, listing_id, value, block, salary):
+    """Registers a simhash in the index and its bands.
+    The bands are keyed by block and salary bucket, so listings from other places,
+    with other schedules or other salaries are never compared.
+
+    Parameters
+    ----------
+    index : dict
+        The fingerprints index.
+
+    listing_id : str
+        The id of the listing.
+
+    value : int
+        The simhash.
+
+    block : str
+        The block key, see block_key().
+
+    salary : int
+        The salary.
+
+    """
+
+    index["simhashes"][listing_id] = (value, block, salary)
+    bucket = salary // SALARY_ROUNDING
+
+    for band in range(BANDS):
+        key = (block, bucket, value >> (band * BAND_BITS) & BAND_MASK)
+        index["bands"][band].setdefault(key, list()).append(listing_id)
+
+
+def find_near_duplicate(index, listing_id, value, block, salary):
+    """Looks for a listing with the same block, a salary within SALARY_ROUNDING
+    and a simhash within MAX_DISTANCE bits.
+
+    Parameters
+    ----------
+    index : dict
+        The fingerprints index.
+
+    listing_id : str
+        The id of the listing, it is never reported as its own duplicate.
+
+    value : int
+        The simhash.
+
+    block : str
+        The block key, see block_key().
+
+    salary : int
+        The salary.
+
+    Returns
+    -------
+    str
+        The id of the first matching listing, None if there is no match.
+
+    """
+
+    bucket = salary // SALARY_ROUNDING
+
+    for band in range(BANDS):
+        bits = value >> (band * BAND_BITS) & BAND_MASK
+
+        # A close salary can fall in the next bucket.
+        for neighbour in [bucket - 1, bucket, bucket + 1]:
+            for candidate in index["bands"][band].get((block, neighbour, bits), []):
+
+                if candidate == listing_id:
+                    continue
+
+                candidate_value, _, candidate_salary = index["simhashes"][candidate]
+
+                if (abs(candidate_salary - salary) <= SALARY_ROUNDING and
+                        bin(candidate_value ^ value).count("1") <= MAX_DISTANCE):
+                    return candidate
+
+    return None
+
+
+def check(index, listing_id, row):
+    """Checks if the row duplicates a listing already in the index and registers it if not.
+    A vacancy listed in several states is saved once per state under the same id,
+    every copy after the first one is a duplicate of that id.
+
+    Parameters
+    ----------
+    index : dict
+        The fingerprints index.
+
+    listing_id : str
+        The id of the listing.
+
+    row : tuple
+        A row as returned by step2.parse_html().
+
+    Returns
+    -------
+    str
+        The id of the original listing, an empty string if the row is not a duplicate.
+
+    """
+
+    if listing_id in index["simhashes"]:
+        metrics.increment("dedup_duplicates_total", kind="id")
+        return listing_id
+
+    digest = exact_hash(row)
+    original = index["exact"].get(digest)
+
+    if original is not None:
+        metrics.increment("dedup_duplicates_total", kind="exact")
+        return original
+
+    value = simhash(row)
+    block = block_key(row)
+    salary = int(row[2])
+    original = find_near_duplicate(index, listing_id, value, block, salary)
+
+    if original is not None:
+        metrics.increment("dedup_duplicates_total", kind="near")
+        return original
+
+    index["exact"][digest] = listing_id
+    add_simhash(index, listing_id, value, block, salary)
+
+    return ""
+
+
+def listing_id(file_name):
+    """Gets the listing id from the name of its file.
+
+    Parameters
+    ----------
+    file_name : str
+        The relative file path of the HTML document.
+
+    Returns
+    -------
+    str
+        The listing id.
+
+    """
+
+    return file_name.split("/")[-1].replace(".html", "")
+
+
+def synthetic_rows(count, seed=0):
+    """Generates rows that look like step2 rows, with a share of exact and near reposts.
+
+    Parameters
+    ----------
+    count : int
+        The number of rows to generate.
+
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    generator
+        Tuples of (listing id, row).
+
+    """
+
+    generator = random.Random(seed)
+    syllables = ["ca", "jo", "ven", "de", "dor", "au", "xi", "liar", "ge", "ren", "te",
+                 "al", "ma", "cen", "con", "ta", "ope", "ra", "pro", "duc", "ion", "su"]
+    words = ["".join(generator.choices(syllables, k=generator.randint(2, 4)))
+             for _ in range(3000)]
+    states = ["Estado {}".format(number) for number in range(32)]
+    recent = list()
+
+    for number in range(count):
+
+        choice = generator.random()
+
+        if recent and choice < 0.1:
+            # Exact repost under a new id.
+            row = generator.choice(recent)
+        elif recent and choice < 0.15:
+            # Repost with a small salary change.
+            row = list(generator.choice(recent))
+            row[2] += generator.randint(-100, 100)
+            row = tuple(row)
+        else:
+            row = ("2020-08-01", " ".join(generator.sample(words, generator.randint(2, 4))),
+                   generator.randrange(4000, 40000, 250), "Contrato por tiempo indeterminado",
+                   800, 1800, 10.0, 1, 1, 1, 1, 1, 0, 0, 5, generator.choice(states),
+                   "Municipio {}".format(generator.randrange(200)), "Licenciatura",
+                   "1 - 2 años", "No es requisito")
+
+        recent.append(row)
+
+        if len(recent) > 1000:
+            recent.pop(0)
+
+        yield str(number), row
+
+
+def benchmark(count=1000000):
+    """Measures the throughput of check() on a synthetic corpus.
+
+    Parameters
+    ----------
+    count : int
+        The number of synthetic listings.
+
+    """
+
+    rows = list(synthetic_rows(count))
+    index = create_index()
+    duplicates = 0
+
+    start_time = time.perf_counter()
+
+    for number, row in rows:
+        if check(index, number, row):
+            duplicates += 1
+
+    elapsed = time.perf_counter() - start_time
+
+    print("Listings: {:,}".format(count))
+    print("Duplicates: {:,}".format(duplicates))
+    print("Seconds: {:.2f}".format(elapsed))
+    print("Listings per second: {:,.0f}".format(count / elapsed))
+
+
+if __name__ == "__main__":
+
+    benchmark()
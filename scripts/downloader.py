@@ -0,0 +1,305 @@
+"""
+This module downloads individual job listings, validates them before they are saved
+and keeps a persistent retry queue for the ones that failed.
+Files are written atomically so a corrupted or partial file never reaches the disk.
+"""
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import metrics
+
+
+RETRY_FILE = "./retry_queue.json"
+LOG_FILE = "./log.txt"
+DELTA_HOURS = 0  # 0 for local time, 5 for Mexico Central Time.
+
+# Listings smaller than this are truncated pages or error pages.
+MIN_SIZE = 20000
+
+# Labels that step2.py needs, a listing without them can't be parsed.
+REQUIRED_LABELS = [
+    "Salario neto mensual:",
+    "Horario de trabajo:",
+    "Días laborales:",
+    "Ubicación:",
+    "Estudios Solicitados:",
+    "Idiomas:"
+]
+
+# The delay doubles on every failed attempt: 1, 2, 4, 8... minutes.
+BASE_DELAY = 60
+MAX_ATTEMPTS = 8
+
+
+def validate_listing(status_code, text):
+    """Checks if a downloaded listing is complete.
+
+    Parameters
+    ----------
+    status_code : int
+        The HTTP status code of the response.
+
+    text : str
+        The HTML document of the listing.
+
+    Returns
+    -------
+    str
+        The reason why the listing is not valid, None if it is valid.
+
+    """
+
+    if status_code != 200:
+        return "status"
+
+    if len(text.encode("utf-8")) <= MIN_SIZE:
+        return "size"
+
+    if "Error 404" in text:
+        return "404"
+
+    for label in REQUIRED_LABELS:
+        if label not in text:
+            return "fields"
+
+    return None
+
+
+def save_file(full_path, text):
+    """Writes the file atomically by writing a temporary file and renaming it.
+
+    Parameters
+    ----------
+    full_path : str
+        The relative file path of the HTML document.
+
+    text : str
+        The contents of the file.
+
+    """
+
+    temp_path = full_path + ".tmp"
+
+    with open(temp_path, "w", encoding="utf-8") as temp_file:
+        temp_file.write(text)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+    os.replace(temp_path, full_path)
+
+
+def download_listing(session, url, full_path, log_name, retry_queue):
+    """Downloads a listing and saves it only if it is valid, otherwise it is queued for retry.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session used to download the listing.
+
+    url : str
+        The url of the listing.
+
+    full_path : str
+        The relative file path where the listing will be saved.
+
+    log_name : str
+        The name used in the log file (state/file_name), None if the file is already logged.
+
+    retry_queue : dict
+        The retry queue, as returned by load_retry_queue().
+
+    Returns
+    -------
+    str
+        The HTML document if it was saved, None otherwise.
+
+    """
+
+    try:
+        with metrics.timer("downloader_listing_download_seconds"):
+            response = session.get(url, verify=False)
+
+        with response:
+            status_code = response.status_code
+            text = response.text
+
+    except Exception as error:
+        status_code = None
+        text = ""
+        print("Download Error:", url, error)
+
+    reason = validate_listing(status_code, text)
+
+    if reason is not None:
+        metrics.increment("downloader_listings_invalid_total", reason=reason)
+        add_retry(retry_queue, url, full_path, log_name, reason)
+        print("Invalid Listing:", full_path, reason)
+        return None
+
+    save_file(full_path, text)
+
+    metrics.increment("downloader_listings_saved_total")
+    metrics.increment("downloader_bytes_written_total",
+                      len(text.encode("utf-8")))
+
+    if retry_queue.pop(full_path, None) is not None:
+        save_retry_queue(retry_queue)
+
+    return text
+
+
+def load_retry_queue():
+    """Loads the retry queue from disk.
+
+    Returns
+    -------
+    dict
+        The pending retries keyed by file path.
+
+    """
+
+    if not os.path.exists(RETRY_FILE):
+        return dict()
+
+    with open(RETRY_FILE, "r", encoding="utf-8") as temp_file:
+        return json.load(temp_file)
+
+
+def save_retry_queue(retry_queue):
+    """Saves the retry queue to disk atomically.
+
+    Parameters
+    ----------
+    retry_queue : dict
+        The pending retries keyed by file path.
+
+    """
+
+    save_file(RETRY_FILE, json.dumps(retry_queue, ensure_ascii=False, indent=4))
+
+
+def add_retry(retry_queue, url, full_path, log_name, reason):
+    """Adds a failed listing to the retry queue with an exponential backoff.
+
+    Parameters
+    ----------
+    retry_queue : dict
+        The pending retries keyed by file path.
+
+    url : str
+        The url of the listing.
+
+    full_path : str
+        The relative file path where the listing will be saved.
+
+    log_name : str
+        The name used in the log file (state/file_name), None if the file is already logged.
+
+    reason : str
+        Why the last attempt failed.
+
+    """
+
+    entry = retry_queue.get(full_path, {"url": url, "log_name": log_name, "attempts": 0})
+    entry["attempts"] += 1
+    entry["reason"] = reason
+    entry["next_attempt"] = time.time() + BASE_DELAY * 2 ** (entry["attempts"] - 1)
+
+    # The entry is kept after the last attempt, otherwise the next crawl would find the
+    # listing again and start over.
+    if entry["attempts"] >= MAX_ATTEMPTS:
+        entry["given_up"] = True
+        metrics.increment("downloader_listings_dropped_total")
+        print("Giving Up:", full_path)
+
+    retry_queue[full_path] = entry
+
+    save_retry_queue(retry_queue)
+
+
+def is_waiting(retry_queue, full_path):
+    """Checks if a listing must not be downloaded now, because its retry delay hasn't
+    expired or because it was given up.
+
+    Parameters
+    ----------
+    retry_queue : dict
+        The pending retries keyed by file path.
+
+    full_path : str
+        The relative file path of the listing.
+
+    Returns
+    -------
+    bool
+        True if the listing must be skipped.
+
+    """
+
+    entry = retry_queue.get(full_path)
+
+    if entry is None:
+        return False
+
+    return entry.get("given_up", False) or entry["next_attempt"] > time.time()
+
+
+def process_retry_queue(session, retry_queue, on_saved=None):
+    """Retries every listing whose backoff delay has expired.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session used to download the listings.
+
+    retry_queue : dict
+        The pending retries keyed by file path.
+
+    on_saved : function
+        Optional function called with the log name and HTML text of every recovered listing
+        that is not logged yet.
+
+    """
+
+    for full_path, entry in list(retry_queue.items()):
+
+        if is_waiting(retry_queue, full_path):
+            continue
+
+        metrics.increment("downloader_retries_total")
+        text = download_listing(session, entry["url"], full_path,
+                                entry["log_name"], retry_queue)
+
+        if text is not None:
+            metrics.increment("downloader_retries_recovered_total")
+            print("Recovered:", full_path)
+
+            if on_saved is not None and entry["log_name"] is not None:
+                on_saved(entry["log_name"], text)
+
+        time.sleep(1)
+
+
+def update_log(file_name):
+    """Updates the log file with the file name and the current timestamp.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the file.
+
+    Returns
+    -------
+    str
+        The timestamp written to the log file.
+
+    """
+
+    with open(LOG_FILE, "a", encoding="utf-8") as temp_file:
+        now = datetime.now() - timedelta(hours=DELTA_HOURS)
+        temp_file.write("{},{}\n".format(file_name, now))
+
+    return str(now)
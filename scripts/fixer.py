@@ -1,59 +1,97 @@
 """
-This script fixes corrupted files by redownloading them.
+This script retries the listings that failed validation during the scraping.
+With the --full flag it also checks every saved file and redownloads the corrupted ones,
+this is only needed for files saved before the scraper validated its downloads.
 """
 
 import os
+import sys
 import time
+from datetime import datetime
 
 import requests
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+import downloader
+import metrics
+
 
 MAIN_FOLDER = "./states/"
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:61.0) Gecko/20100101 Firefox/61.0"}
 
+main_session = requests.Session()
+main_session.headers.update(HEADERS)
+
+
+def main(full_scan=False):
+    """Process the retry queue and optionally iterate over each folder and check each file.
+
+    Parameters
+    ----------
+    full_scan : bool
+        Whether to check every saved file.
+
+    """
+
+    started_at = datetime.now()
+
+    try:
+        with metrics.profile("fixer"):
 
-def main():
-    """Iterate over each folder and check each file."""
+            retry_queue = downloader.load_retry_queue()
+            downloader.process_retry_queue(
+                main_session, retry_queue, on_saved=lambda log_name, text: downloader.update_log(log_name))
 
-    for folder in os.listdir(MAIN_FOLDER):
+            if full_scan:
 
-        for file in os.listdir(MAIN_FOLDER + folder):
+                for folder in os.listdir(MAIN_FOLDER):
 
-            full_path = MAIN_FOLDER + folder + "/" + file
+                    for file in os.listdir(MAIN_FOLDER + folder):
 
-            if os.stat(full_path).st_size <= 20000:
-                redownload(full_path)
+                        # Leftovers of an interrupted atomic write.
+                        if file.endswith(".tmp"):
+                            continue
 
-            check_file(full_path)
+                        full_path = MAIN_FOLDER + folder + "/" + file
+                        metrics.increment("fixer_files_checked_total")
 
+                        check_file(full_path, retry_queue)
+    finally:
+        metrics.write_report("fixer", started_at)
 
-def redownload(full_path):
-    """Redownload the specified file.
+
+def redownload(full_path, retry_queue):
+    """Redownload the specified file, it is only replaced if the new download is valid.
 
     Parameters
     ----------
     full_path : str
         The relative file path of the HTML document.
 
+    retry_queue : dict
+        The retry queue, as returned by downloader.load_retry_queue().
+
     """
 
+    if downloader.is_waiting(retry_queue, full_path):
+        return
+
     file_id = full_path.split("/")[-1].replace(".html", "")
     base_url = f"https://www.empleo.gob.mx/{file_id}-oferta-de-empleo-de-empleado-test-"
 
-    with requests.get(base_url, headers=HEADERS, verify=False) as response:
+    # The file is already in the log, so it is queued without a log name.
+    if downloader.download_listing(main_session, base_url, full_path, None, retry_queue) is not None:
+        metrics.increment("fixer_files_redownloaded_total")
+        print("Redownloaded:", full_path)
 
-        with open(full_path, "w", encoding="utf-8") as temp_file:
-            temp_file.write(response.text)
-            print("Redownloaded:", full_path)
-            time.sleep(1)
+    time.sleep(1)
 
 
-def check_file(full_path):
+def check_file(full_path, retry_queue):
     """Check if the specified file was incorrectly downloaded.
 
     Parameters
@@ -61,17 +99,22 @@ def check_file(full_path):
     full_path : str
         The relative file path of the HTML document.
 
+    retry_queue : dict
+        The retry queue, as returned by downloader.load_retry_queue().
+
     """
 
     with open(full_path, "r", encoding="utf-8") as temp_file:
-
         file_text = temp_file.read()
 
-        if "Error 404" in file_text:
-            print("Error", full_path)
-            redownload(full_path)
+    reason = downloader.validate_listing(200, file_text)
+
+    if reason is not None:
+        metrics.increment("fixer_files_corrupted_total", reason=reason)
+        print("Error", full_path, reason)
+        redownload(full_path, retry_queue)
 
 
 if __name__ == "__main__":
 
-    main()
+    main(full_scan="--full" in sys.argv[1:])
@@ -0,0 +1,252 @@
+"""
+This module collects counters and latency histograms for every stage of the pipeline.
+At the end of a run each stage writes a JSON report and a Prometheus text-format file.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+METRICS_FOLDER = "./metrics/"
+
+# Set this environment variable to "1" to enable cProfile for every stage.
+PROFILE_VARIABLE = "MEXICAN_JOBS_PROFILE"
+
+# Upper bounds of the histogram buckets, in seconds and in bytes.
+SECONDS_BUCKETS = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BYTES_BUCKETS = [1000, 5000, 10000, 20000, 50000, 100000, 250000, 500000, 1000000]
+
+COUNTERS = dict()
+HISTOGRAMS = dict()
+
+# Stages can run threads (see pipeline.py), the lock keeps the updates consistent.
+LOCK = threading.Lock()
+
+
+def increment(name, value=1, **labels):
+    """Increments a counter.
+
+    Parameters
+    ----------
+    name : str
+        The name of the counter.
+
+    value : int
+        The amount to add to the counter.
+
+    labels : str
+        Optional labels that identify the series.
+
+    """
+
+    key = (name, tuple(sorted(labels.items())))
+
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """Records a value into a histogram.
+
+    Parameters
+    ----------
+    name : str
+        The name of the histogram.
+
+    value : float
+        The observed value.
+
+    buckets : list
+        The upper bounds of the buckets, only used the first time the histogram is seen.
+
+    labels : str
+        Optional labels that identify the series.
+
+    """
+
+    key = (name, tuple(sorted(labels.items())))
+
+    with LOCK:
+
+        if key not in HISTOGRAMS:
+            HISTOGRAMS[key] = {"buckets": list(buckets),
+                               "counts": [0] * len(buckets),
+                               "count": 0,
+                               "sum": 0}
+
+        histogram = HISTOGRAMS[key]
+        histogram["count"] += 1
+        histogram["sum"] += value
+
+        for index, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][index] += 1
+                break
+
+
+@contextmanager
+def timer(name, **labels):
+    """Measures the time spent inside the block and records it into a histogram.
+
+    Parameters
+    ----------
+    name : str
+        The name of the histogram.
+
+    labels : str
+        Optional labels that identify the series.
+
+    """
+
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
+
+
+@contextmanager
+def profile(stage):
+    """Runs the block under cProfile when the profile environment variable is set.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage, used for the output file name.
+
+    """
+
+    if os.environ.get(PROFILE_VARIABLE) != "1":
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        profiler.dump_stats("{}{}.prof".format(METRICS_FOLDER, stage))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+
+def format_labels(labels, extra=None):
+    """Formats a labels tuple using the Prometheus syntax.
+
+    Parameters
+    ----------
+    labels : tuple
+        A tuple of (name, value) pairs.
+
+    extra : tuple
+        An additional (name, value) pair.
+
+    Returns
+    -------
+    str
+        The formatted labels, empty if there are none.
+
+    """
+
+    pairs = list(labels)
+
+    if extra is not None:
+        pairs.append(extra)
+
+    if not pairs:
+        return ""
+
+    escaped = ['{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+               for label, value in pairs]
+
+    return "{" + ",".join(escaped) + "}"
+
+
+def write_report(stage, started_at=None):
+    """Writes the collected metrics as a JSON run report and a Prometheus text file.
+    Each stage calls it in a finally block, so a run that fails also leaves a report
+    with the error that stopped it.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage (scraper, fixer, step2, step3).
+
+    started_at : datetime
+        When the run started, used to compute the total duration.
+
+    """
+
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    finished_at = datetime.now()
+
+    # Inside a finally block this is the exception that is stopping the run.
+    error = sys.exc_info()[1]
+
+    with LOCK:
+
+        report = {
+            "stage": stage,
+            "started_at": started_at.isoformat() if started_at else None,
+            "finished_at": finished_at.isoformat(),
+            "duration_seconds": (finished_at - started_at).total_seconds() if started_at else None,
+            "error": repr(error) if error is not None else None,
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(COUNTERS.items())],
+            "histograms": [{"name": name, "labels": dict(labels), **histogram}
+                           for (name, labels), histogram in sorted(HISTOGRAMS.items())]
+        }
+
+        # 1 when the run failed, so an alert doesn't depend on the report being parsed.
+        lines = ["# TYPE run_failed gauge",
+                 "run_failed{} {}".format(format_labels([("stage", stage)]), int(error is not None))]
+
+        for name in sorted({name for name, _ in COUNTERS}):
+            lines.append("# TYPE {} counter".format(name))
+
+            for (counter_name, labels), value in sorted(COUNTERS.items()):
+                if counter_name == name:
+                    lines.append("{}{} {}".format(
+                        name, format_labels(labels), value))
+
+        for name in sorted({name for name, _ in HISTOGRAMS}):
+            lines.append("# TYPE {} histogram".format(name))
+
+            for (histogram_name, labels), histogram in sorted(HISTOGRAMS.items()):
+
+                if histogram_name != name:
+                    continue
+
+                # Prometheus buckets are cumulative.
+                cumulative = 0
+
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels, ("le", bound)), cumulative))
+
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(labels, ("le", "+Inf")), histogram["count"]))
+                lines.append("{}_sum{} {}".format(
+                    name, format_labels(labels), histogram["sum"]))
+                lines.append("{}_count{} {}".format(
+                    name, format_labels(labels), histogram["count"]))
+
+    with open("{}{}.json".format(METRICS_FOLDER, stage), "w", encoding="utf-8") as temp_file:
+        json.dump(report, temp_file, ensure_ascii=False, indent=4)
+
+    with open("{}{}.prom".format(METRICS_FOLDER, stage), "w", encoding="utf-8") as temp_file:
+        temp_file.write("\n".join(lines) + "\n")
+
+    print("Metrics Saved:", "{}{}.json".format(METRICS_FOLDER, stage))
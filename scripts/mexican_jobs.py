@@ -0,0 +1,251 @@
+"""
+This is the single entry point of the project: python mexican_jobs.py <command>.
+Each command imports its modules only when it runs, so short tasks like fix
+don't pay for selenium, lxml, pandas or plotly.
+"""
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+
+# The modules each command imports, used by the startup benchmark.
+COMMAND_MODULES = {
+    "crawl": ["scraper"],
+    "fix": ["fixer"],
+    "fix-schedules": ["step2"],
+    "extract": ["step2"],
+    "shard": ["shards"],
+    "merge": ["shards"],
+    "analyze": ["step3"],
+    "bench": ["dedup"]
+}
+
+# Benchmark name: (module, function).
+BENCHMARKS = {
+    "dedup": ("dedup", "benchmark"),
+    "store": ("store", "benchmark"),
+    "cube": ("cube", "benchmark"),
+    "columns": ("columns", "benchmark"),
+    "partitions": ("partitions", "benchmark"),
+    "titles": ("titles", "benchmark"),
+    "report": ("report", "benchmark"),
+    "schedules": ("step2", "benchmark"),
+    "startup": ("mexican_jobs", "benchmark_startup")
+}
+
+
+def main(args=None):
+    """Parses the command line and runs the selected command.
+
+    Parameters
+    ----------
+    args : list
+        The command line arguments, sys.argv is used when None.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="mexican_jobs.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crawl_parser = commands.add_parser("crawl", help="Download the new job listings.")
+    crawl_parser.add_argument("--pipeline", action="store_true",
+                              help="Parse the listings while they are downloaded.")
+    crawl_parser.add_argument("--cube", metavar="PATH",
+                              help="Update this rollup cube with the new rows, needs --pipeline.")
+    crawl_parser.add_argument("--titles", metavar="PATH",
+                              help="Update this index of title words with the new rows, needs --pipeline.")
+    crawl_parser.set_defaults(function=run_crawl)
+
+    fix_parser = commands.add_parser("fix", help="Retry the listings that failed validation.")
+    fix_parser.add_argument("--full", action="store_true",
+                            help="Also check every saved file.")
+    fix_parser.set_defaults(function=run_fix)
+
+    schedules_parser = commands.add_parser(
+        "fix-schedules", help="Recompute the hours and days worked of an existing data.csv.")
+    schedules_parser.add_argument("csv_file", nargs="?", default="data.csv", metavar="PATH",
+                                  help="The .csv file to be fixed, data.csv by default.")
+    schedules_parser.add_argument("--cube", metavar="PATH",
+                                  help="Also rebuild this rollup cube from the fixed file.")
+    schedules_parser.add_argument("--dataset", metavar="PATH",
+                                  help="Also rebuild this partitioned dataset from the fixed file.")
+    schedules_parser.add_argument("--titles", metavar="PATH",
+                                  help="Also rebuild this index of title words from the fixed file.")
+    schedules_parser.set_defaults(function=run_fix_schedules)
+
+    extract_parser = commands.add_parser("extract", help="Extract the dataset from the listings.")
+    add_output_arguments(extract_parser)
+    extract_parser.add_argument("--workers", type=int, metavar="N",
+                                help="Split the extraction into N shards, each one in its own process.")
+    add_shard_arguments(extract_parser)
+    extract_parser.set_defaults(function=run_extract)
+
+    shard_parser = commands.add_parser("shard", help="Extract a single shard into a partial output.")
+    shard_parser.add_argument("shard", type=int, help="The shard number, starting at 0.")
+    shard_parser.add_argument("--shards", type=int, required=True, metavar="N",
+                              help="The number of shards.")
+    add_shard_arguments(shard_parser)
+    shard_parser.set_defaults(function=run_shard)
+
+    merge_parser = commands.add_parser("merge", help="Merge the partial outputs of the shards.")
+    merge_parser.add_argument("--folder", default="./shards/", metavar="PATH",
+                              help="The folder with the partial outputs.")
+    add_output_arguments(merge_parser)
+    merge_parser.set_defaults(function=run_merge)
+
+    analyze_parser = commands.add_parser("analyze", help="Render the figures.")
+    analyze_parser.add_argument("figures", nargs="*",
+                                help="The figure functions to run, see step3.FIGURES. "
+                                     "All of them by default.")
+    analyze_parser.add_argument("--cube", metavar="PATH",
+                                help="Read the aggregates from this rollup cube instead of data.csv.")
+    analyze_parser.add_argument("--report", metavar="PATH",
+                                help="Save the figures into this single HTML page instead of PNG files.")
+    analyze_parser.add_argument("--dataset", metavar="PATH",
+                                help="Read the offers from this partitioned dataset instead of data.csv.")
+    analyze_parser.add_argument("--start", metavar="DATE",
+                                help="The first date to include, in ISO format.")
+    analyze_parser.add_argument("--end", metavar="DATE",
+                                help="The last date to include, in ISO format.")
+    analyze_parser.add_argument("--state", action="append", dest="states", metavar="STATE",
+                                help="A state to include, can be repeated. All of them by default.")
+    analyze_parser.set_defaults(function=run_analyze)
+
+    bench_parser = commands.add_parser("bench", help="Run a benchmark.")
+    bench_parser.add_argument("name", choices=sorted(BENCHMARKS))
+    bench_parser.set_defaults(function=run_bench)
+
+    arguments = parser.parse_args(args)
+    arguments.function(arguments)
+
+
+def add_output_arguments(parser):
+    """Adds the optional outputs of the extraction to a command."""
+
+    parser.add_argument("--database", metavar="PATH",
+                        help="Also load the rows into this SQLite database.")
+    parser.add_argument("--cube", metavar="PATH",
+                        help="Also rebuild this rollup cube from the rows.")
+    parser.add_argument("--dataset", metavar="PATH",
+                        help="Also rebuild this partitioned dataset from the rows.")
+    parser.add_argument("--titles", metavar="PATH",
+                        help="Also rebuild this index of title words from the rows.")
+
+
+def add_shard_arguments(parser):
+    """Adds the shard key and the shared folder to a command."""
+
+    parser.add_argument("--key", choices=["listing", "state"], default="listing",
+                        help="Assign the files to shards by listing id or by state.")
+    parser.add_argument("--folder", default="./shards/", metavar="PATH",
+                        help="The folder where the partial outputs are saved.")
+
+
+def output_options(arguments):
+    """Gets the optional outputs of the extraction as keyword arguments of step2.main()."""
+
+    return {"database_file": arguments.database, "cube_file": arguments.cube,
+            "dataset_folder": arguments.dataset, "titles_file": arguments.titles}
+
+
+def run_crawl(arguments):
+    """Runs the scraper, or the streaming pipeline with --pipeline."""
+
+    if arguments.pipeline:
+        importlib.import_module("pipeline").main(cube_file=arguments.cube,
+                                                 titles_file=arguments.titles)
+    else:
+        importlib.import_module("scraper").main()
+
+
+def run_fix(arguments):
+    """Runs the fixer."""
+
+    importlib.import_module("fixer").main(full_scan=arguments.full)
+
+
+def run_fix_schedules(arguments):
+    """Fixes the schedule columns of a .csv file and rebuilds the selected outputs."""
+
+    importlib.import_module("step2").fix_schedules(arguments.csv_file, cube_file=arguments.cube,
+                                                   dataset_folder=arguments.dataset,
+                                                   titles_file=arguments.titles)
+
+
+def run_extract(arguments):
+    """Runs the extraction, split into local worker processes with --workers."""
+
+    if arguments.workers:
+        importlib.import_module("shards").run_local(arguments.workers, arguments.key,
+                                                    arguments.folder, **output_options(arguments))
+    else:
+        importlib.import_module("step2").main(**output_options(arguments))
+
+
+def run_shard(arguments):
+    """Extracts a single shard."""
+
+    importlib.import_module("shards").run_shard(arguments.shard, arguments.shards,
+                                                arguments.key, arguments.folder)
+
+
+def run_merge(arguments):
+    """Merges the partial outputs of the shards."""
+
+    importlib.import_module("shards").merge(arguments.folder, **output_options(arguments))
+
+
+def run_analyze(arguments):
+    """Renders the selected figures."""
+
+    step3 = importlib.import_module("step3")
+    step3.main(arguments.figures or step3.FIGURES, cube_file=arguments.cube,
+               dataset_folder=arguments.dataset, start_date=arguments.start,
+               end_date=arguments.end, states=arguments.states,
+               report_file=arguments.report)
+
+
+def run_bench(arguments):
+    """Runs the selected benchmark."""
+
+    module_name, function_name = BENCHMARKS[arguments.name]
+    getattr(importlib.import_module(module_name), function_name)()
+
+
+def benchmark_startup():
+    """Measures the import time of every command with python -X importtime."""
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    print("| Command | Import time (ms) |")
+    print("|---|---:|")
+
+    for command, modules in COMMAND_MODULES.items():
+
+        code = "import " + ", ".join(["mexican_jobs"] + modules)
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                cwd=folder, capture_output=True, text=True)
+
+        if result.returncode != 0:
+            print("| {} | failed: {} |".format(
+                command, result.stderr.strip().splitlines()[-1]))
+            continue
+
+        # Each line looks like: import time: self [us] | cumulative | imported package
+        total = 0
+
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+
+            if line.startswith("import time:") and fields[0].split(":")[1].strip().isdigit():
+                total += int(fields[0].split(":")[1])
+
+        print("| {} | {:,.1f} |".format(command, total / 1000))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,415 @@
+"""
+This module saves the job offers as a partitioned dataset, one folder per year, month
+and state (year=2020/month=08/state=Jalisco) with Parquet files inside.
+Every crawl is kept and a question about one month or one state only reads the
+files of its partitions instead of the whole history.
+"""
+
+import csv
+import os
+import shutil
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import columns
+import store
+
+
+DATASET_FOLDER = "./dataset/"
+
+ARROW_TYPES = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+
+SCHEMA = pa.schema([(column, ARROW_TYPES[column_type])
+                    for column, column_type in store.COLUMN_TYPES.items()])
+
+# The name of the single file of a compacted partition.
+COMPACTED_NAME = "part-compacted.parquet"
+
+
+def partition_folder(dataset_folder, year, month, state):
+    """Gets the folder of a partition.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        The root folder of the dataset.
+
+    year : str
+        The year, 4 digits.
+
+    month : str
+        The month, 2 digits.
+
+    state : str
+        The state name, the same used in the states folders.
+
+    Returns
+    -------
+    str
+        The path of the partition folder.
+
+    """
+
+    return os.path.join(dataset_folder, "year=" + year, "month=" + month, "state=" + state)
+
+
+def start_dataset(dataset_folder=DATASET_FOLDER):
+    """Prepares an empty temporary folder where the dataset is written.
+    The current dataset stays usable until finish_dataset() replaces it.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        The root folder of the dataset.
+
+    Returns
+    -------
+    str
+        The temporary folder.
+
+    """
+
+    temp_folder = dataset_folder.rstrip("/") + ".tmp"
+
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+
+    os.makedirs(temp_folder)
+
+    return temp_folder
+
+
+def finish_dataset(temp_folder, dataset_folder=DATASET_FOLDER):
+    """Compacts the dataset written in the temporary folder and replaces the current one.
+
+    Parameters
+    ----------
+    temp_folder : str
+        The folder returned by start_dataset().
+
+    dataset_folder : str
+        The root folder of the dataset.
+
+    """
+
+    compact_partitions(temp_folder)
+
+    if os.path.exists(dataset_folder):
+        shutil.rmtree(dataset_folder)
+
+    os.replace(temp_folder, dataset_folder.rstrip("/"))
+
+
+def write_partitions(buffer, dataset_folder, part_name):
+    """Writes a batch of rows, each partition in the batch gets its own file.
+
+    Parameters
+    ----------
+    buffer : columns.ColumnBuffer
+        The rows, with the same columns as store.COLUMNS.
+
+    dataset_folder : str
+        The root folder of the dataset.
+
+    part_name : str
+        The file name used in every partition, it must be unique for each batch.
+
+    """
+
+    values = {column: buffer.column(column) for column in store.COLUMNS}
+
+    # Empty strings are saved as nulls, like pandas reads them from the .csv file.
+    values["duplicate_of"] = [value or None for value in values["duplicate_of"]]
+
+    partitions = dict()
+
+    for position, (isodate, state) in enumerate(zip(values["isodate"], values["state"])):
+        partitions.setdefault((isodate[:4], isodate[5:7], state), []).append(position)
+
+    for (year, month, state), positions in partitions.items():
+
+        folder = partition_folder(dataset_folder, year, month, state)
+        os.makedirs(folder, exist_ok=True)
+
+        table = pa.Table.from_pydict(
+            {column: [values[column][position] for position in positions]
+             for column in store.COLUMNS}, schema=SCHEMA)
+
+        pq.write_table(table, os.path.join(folder, part_name + ".parquet"))
+
+
+def build_from_csv(csv_file="data.csv", dataset_folder=DATASET_FOLDER):
+    """Rebuilds the dataset from an existing .csv file produced by step2.
+
+    Parameters
+    ----------
+    csv_file : str
+        The path of the .csv file.
+
+    dataset_folder : str
+        The root folder of the dataset, it is replaced at the end.
+
+    """
+
+    import step2
+
+    temp_folder = start_dataset(dataset_folder)
+    buffer = columns.ColumnBuffer(store.COLUMNS, store.COLUMN_TYPES.values())
+    batches = 0
+
+    for row in store.read_rows(csv_file):
+        buffer.append(row)
+
+        if len(buffer) == step2.BATCH_SIZE:
+            write_partitions(buffer, temp_folder, "part-{:05d}".format(batches))
+            buffer.clear()
+            batches += 1
+
+    if buffer:
+        write_partitions(buffer, temp_folder, "part-{:05d}".format(batches))
+
+    finish_dataset(temp_folder, dataset_folder)
+
+
+def compact_partitions(dataset_folder):
+    """Merges the files of each partition into a single file.
+    Every batch of step2 writes a small file in each partition it touches, so a partition
+    can have hundreds of them. Reading one file per partition is much faster.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        The root folder of the dataset.
+
+    """
+
+    partitions = dict()
+
+    for file_name in find_files(dataset_folder):
+        partitions.setdefault(os.path.dirname(file_name), []).append(file_name)
+
+    for folder, files_list in partitions.items():
+
+        if len(files_list) == 1:
+            continue
+
+        # The files are read in name order, the same order load_dataset() uses.
+        table = pa.concat_tables([pq.ParquetFile(file_name).read() for file_name in files_list])
+        pq.write_table(table, os.path.join(folder, COMPACTED_NAME + ".tmp"))
+
+        for file_name in files_list:
+            os.remove(file_name)
+
+        os.replace(os.path.join(folder, COMPACTED_NAME + ".tmp"),
+                   os.path.join(folder, COMPACTED_NAME))
+
+
+def find_files(dataset_folder=DATASET_FOLDER, start_date=None, end_date=None, states=None):
+    """Gets the files of the partitions that can contain matching offers.
+    Only the folder names are read, the other partitions are never opened.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        The root folder of the dataset.
+
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    states : list
+        The states to include, all of them by default.
+
+    Returns
+    -------
+    list
+        The paths of the Parquet files.
+
+    """
+
+    # Partitions are compared by year and month, the exact dates are filtered later.
+    first_month = start_date[:7] if start_date is not None else None
+    last_month = end_date[:7] if end_date is not None else None
+
+    files_list = list()
+
+    for year_folder in sorted(os.listdir(dataset_folder)):
+        for month_folder in sorted(os.listdir(os.path.join(dataset_folder, year_folder))):
+
+            partition_month = "{}-{}".format(year_folder.split("=")[1], month_folder.split("=")[1])
+
+            if first_month is not None and partition_month < first_month:
+                continue
+
+            if last_month is not None and partition_month > last_month:
+                continue
+
+            month_path = os.path.join(dataset_folder, year_folder, month_folder)
+
+            for state_folder in sorted(os.listdir(month_path)):
+
+                if states is not None and state_folder.split("=", 1)[1] not in states:
+                    continue
+
+                state_path = os.path.join(month_path, state_folder)
+
+                for file_name in sorted(os.listdir(state_path)):
+                    files_list.append(os.path.join(state_path, file_name))
+
+    return files_list
+
+
+def load_dataset(dataset_folder=DATASET_FOLDER, start_date=None, end_date=None, states=None,
+                 columns_list=None):
+    """Loads the offers that match the filters, reading only their partitions.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        The root folder of the dataset.
+
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    states : list
+        The states to include, all of them by default.
+
+    columns_list : list
+        The columns to load, all of them by default.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The matching offers, isodate is parsed as a date like in step3.load_data().
+
+    """
+
+    import pandas as pd
+
+    files_list = find_files(dataset_folder, start_date, end_date, states)
+
+    # ParquetFile reads a single file, so the folder names are not parsed as extra columns.
+    if files_list:
+        table = pa.concat_tables([pq.ParquetFile(file_name).read(columns=columns_list)
+                                  for file_name in files_list])
+    else:
+        table = SCHEMA.empty_table()
+
+        if columns_list is not None:
+            table = table.select(columns_list)
+
+    df = table.to_pandas()
+
+    if "isodate" in df.columns:
+        df["isodate"] = pd.to_datetime(df["isodate"])
+
+        if start_date is not None:
+            df = df[df["isodate"] >= start_date]
+
+        if end_date is not None:
+            df = df[df["isodate"] <= end_date]
+
+    return df
+
+
+def benchmark(csv_file=store.SAMPLE_FILE, months=24):
+    """Compares loading one month and one state against loading the whole history,
+    on the dataset step2 writes before and after it is compacted.
+
+    Parameters
+    ----------
+    csv_file : str
+        The rows copied into every month of the history, see store.simulate_history().
+
+    months : int
+        The number of months in the history.
+
+    """
+
+    import pandas as pd
+
+    import step2
+
+    seed_rows = list(store.read_rows(csv_file))
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        dataset_folder = os.path.join(folder, "dataset")
+        csv_path = os.path.join(folder, "data.csv")
+        buffer = columns.ColumnBuffer(store.COLUMNS, store.COLUMN_TYPES.values())
+        batches = 0
+
+        def write_batch(writer):
+            nonlocal batches
+            writer.writerows(buffer.rows())
+            write_partitions(buffer, dataset_folder, "part-{:05d}".format(batches))
+            buffer.clear()
+            batches += 1
+
+        with open(csv_path, "w", encoding="utf-8", newline="") as temp_file:
+
+            writer = csv.writer(temp_file)
+            writer.writerow(store.COLUMNS)
+
+            for row in store.simulate_history(seed_rows, months):
+                buffer.append(row)
+
+                # The rows keep the log order and are written in batches, like step2.main().
+                if len(buffer) == step2.BATCH_SIZE:
+                    write_batch(writer)
+
+            if buffer:
+                write_batch(writer)
+
+        last_month = store.simulated_month(months - 1)
+
+        queries = [
+            ("whole history, .csv file", lambda: pd.read_csv(csv_path, parse_dates=["isodate"])),
+            ("whole history, dataset", lambda: load_dataset(dataset_folder)),
+            ("one month", lambda: load_dataset(dataset_folder, last_month + "-01",
+                                               last_month + "-28")),
+            ("one month and state", lambda: load_dataset(dataset_folder, last_month + "-01",
+                                                         last_month + "-28", ["Jalisco"])),
+            ("one state", lambda: load_dataset(dataset_folder, states=["Jalisco"]))
+        ]
+
+        results = {name: list() for name, _ in queries}
+        files = list()
+
+        for compact in [False, True]:
+
+            if compact:
+                start_time = time.perf_counter()
+                compact_partitions(dataset_folder)
+                compact_seconds = time.perf_counter() - start_time
+
+            files.append(len(find_files(dataset_folder)))
+
+            for name, function in queries:
+
+                start_time = time.perf_counter()
+                df = function()
+                results[name].append((len(df), time.perf_counter() - start_time))
+
+        print("History: {:,} rows, {} months, {} batches of {:,} rows".format(
+            len(seed_rows) * months, months, batches, step2.BATCH_SIZE))
+        print("Files: {:,} after step2, {:,} compacted in {:.2f} seconds".format(
+            files[0], files[1], compact_seconds))
+        print("| Query | Rows | step2 files (s) | Compacted (s) |")
+        print("|---|---:|---:|---:|")
+
+        for name, ((rows, seconds), (_, compacted_seconds)) in results.items():
+            print("| {} | {:,} | {:.3f} | {:.3f} |".format(name, rows, seconds, compacted_seconds))
+
+
+if __name__ == "__main__":
+
+    benchmark()
@@ -0,0 +1,284 @@
+"""
+This script runs the scraper and the extraction at the same time.
+Downloaded listings flow through bounded in-process queues into the step2 parser
+and the rows are appended to the .csv file while the crawl is still in progress.
+The raw HTML files and log.txt are still saved by the scraper for auditing.
+"""
+
+import csv
+import os
+import queue
+import threading
+from datetime import datetime
+
+import cube
+import dedup
+import metrics
+import scraper
+import step2
+import titles
+
+
+# Bounded queues keep the memory flat, the scraper waits when the parsers fall behind.
+LISTINGS_QUEUE_SIZE = 50
+ROWS_QUEUE_SIZE = 500
+
+PARSER_THREADS = 2
+OUTPUT_FILE = "data.csv"
+
+# Signals the end of a queue.
+SENTINEL = None
+
+
+def main(cube_file=None, titles_file=None):
+    """Runs the pipeline and saves its metrics.
+
+    Parameters
+    ----------
+    cube_file : str
+        Optional rollup cube that is updated with the new rows, see cube.py.
+
+    titles_file : str
+        Optional index of the title words that is updated with the new rows, see titles.py.
+
+    """
+
+    started_at = datetime.now()
+
+    try:
+        with metrics.profile("pipeline"):
+            run(cube_file=cube_file, titles_file=titles_file)
+    finally:
+        metrics.write_report("pipeline", started_at)
+
+
+def run(output_file=OUTPUT_FILE, cube_file=None, titles_file=None):
+    """Starts the crawler, the parser threads and the writer and waits for them to finish.
+
+    Parameters
+    ----------
+    output_file : str
+        The .csv file where the new rows will be appended.
+
+    cube_file : str
+        Optional rollup cube that is updated with the new rows, see cube.py.
+
+    titles_file : str
+        Optional index of the title words that is updated with the new rows, see titles.py.
+
+    """
+
+    # Checked before the crawl starts, a wrong file would stop it at the first row.
+    check_header(output_file)
+
+    listings_queue = queue.Queue(maxsize=LISTINGS_QUEUE_SIZE)
+    rows_queue = queue.Queue(maxsize=ROWS_QUEUE_SIZE)
+
+    # Set by the writer when it fails, the crawl and the parsers stop and run() raises its error.
+    stop_event = threading.Event()
+    errors = list()
+
+    parsers = [threading.Thread(target=parse_listings,
+                                args=(listings_queue, rows_queue, stop_event))
+               for _ in range(PARSER_THREADS)]
+
+    writer = threading.Thread(target=write_rows, args=(
+        rows_queue, output_file, PARSER_THREADS, cube_file, titles_file, stop_event, errors))
+
+    for thread in parsers:
+        thread.start()
+
+    writer.start()
+
+    def enqueue_listing(state, file_name, text, file_date):
+        if stop_event.is_set():
+            raise RuntimeError("The writer failed, stopping the crawl")
+
+        with metrics.timer("pipeline_enqueue_wait_seconds"):
+            listings_queue.put((state + "/" + file_name, text, file_date))
+
+        metrics.observe("pipeline_listings_queue_size", listings_queue.qsize(),
+                        buckets=[0, 1, 5, 10, 25, LISTINGS_QUEUE_SIZE])
+
+    try:
+        scraper.crawl(on_listing=enqueue_listing)
+    finally:
+        # Even if the crawl fails we let the parsers drain what was already downloaded.
+        for _ in parsers:
+            listings_queue.put(SENTINEL)
+
+        for thread in parsers:
+            thread.join()
+
+        writer.join()
+
+        # The error of the writer is raised here, so a scheduled run exits with a failure.
+        if errors:
+            raise errors[0]
+
+
+def check_header(output_file):
+    """Checks that an existing .csv file has the same columns as the rows that are appended.
+
+    Parameters
+    ----------
+    output_file : str
+        The .csv file where the new rows will be appended.
+
+    """
+
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return
+
+    with open(output_file, "r", encoding="utf-8", newline="") as csv_file:
+        header = next(csv.reader(csv_file), [])
+
+    # Rows with duplicate_of appended to a 20 column file, like the shipped one, break it.
+    if header != step2.COLUMNS:
+        raise ValueError("{} has other columns, rebuild it with step2.py: {}".format(
+            output_file, ",".join(header)))
+
+
+def parse_listings(listings_queue, rows_queue, stop_event):
+    """Takes listings from the queue, parses them and puts the rows into the rows queue.
+
+    Parameters
+    ----------
+    listings_queue : queue.Queue
+        The queue with the (file name, HTML text, download date) tuples.
+
+    rows_queue : queue.Queue
+        The queue where the (file name, row) tuples are put.
+
+    stop_event : threading.Event
+        Set when the writer failed, the remaining listings are taken but not parsed.
+
+    """
+
+    while True:
+
+        item = listings_queue.get()
+
+        if item is SENTINEL:
+            rows_queue.put(SENTINEL)
+            break
+
+        if stop_event.is_set():
+            continue
+
+        file_name, text, file_date = item
+
+        try:
+            raw_row = step2.parse_html(text, file_date)
+
+            # Listings arrive one by one, so the per row derivation is cheaper than a batch.
+            row = step2.build_row(raw_row, step2.derive_schedule(raw_row[4], raw_row[5]))
+            rows_queue.put((file_name, row))
+            metrics.increment("pipeline_listings_parsed_total")
+        except Exception as error:
+            # The raw file is kept, it can be fixed and parsed later by fixer.py and step2.py.
+            metrics.increment("pipeline_listings_failed_total")
+            print("Parse Error:", file_name, error)
+
+
+def write_rows(rows_queue, output_file, producers, cube_file=None, titles_file=None,
+               stop_event=None, errors=None):
+    """Flags duplicates and appends the rows from the queue to the .csv file
+    until all producers are done.
+
+    Parameters
+    ----------
+    rows_queue : queue.Queue
+        The queue with the (file name, row) tuples.
+
+    output_file : str
+        The .csv file where the rows will be appended.
+
+    producers : int
+        The number of parser threads, each one sends a sentinel when it finishes.
+
+    cube_file : str
+        Optional rollup cube that is updated with the new rows, see cube.py.
+
+    titles_file : str
+        Optional index of the title words that is updated with the new rows, see titles.py.
+        It must have been built from the same .csv file, since its row ids are the row positions.
+
+    stop_event : threading.Event
+        Optional event that is set if writing fails.
+
+    errors : list
+        Optional list where the error is added if writing fails.
+
+    """
+
+    try:
+        write_header = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+
+        # The indexes and the cube are only used by this thread, so they need no lock.
+        index = dedup.load_index()
+        rollup = cube.load_cube(cube_file) if cube_file is not None else None
+        title_index = titles.load_index(titles_file) if titles_file is not None else None
+
+        with open(output_file, "a", encoding="utf-8", newline="") as csv_file:
+
+            writer = csv.writer(csv_file)
+
+            if write_header:
+                writer.writerow(step2.COLUMNS)
+
+            while producers > 0:
+
+                item = rows_queue.get()
+
+                if item is SENTINEL:
+                    producers -= 1
+                    continue
+
+                row = step2.flag_duplicate(index, *item)
+
+                if row is not None:
+                    writer.writerow(row)
+                    metrics.increment("pipeline_rows_written_total")
+
+                    if rollup is not None:
+                        cube.update_cube(rollup, [row])
+
+                    if title_index is not None:
+                        titles.add_rows(title_index, [row])
+
+                # Flush when the queue is drained so the dataset is usable during the crawl.
+                if rows_queue.empty():
+                    csv_file.flush()
+
+        dedup.save_index(index)
+
+        if rollup is not None:
+            cube.save_cube(rollup, cube_file)
+
+        if title_index is not None:
+            titles.save_index(title_index, titles_file)
+
+    except Exception as error:
+        # The indexes and the cube are not saved, they must be rebuilt with step2.py.
+        metrics.increment("pipeline_writer_errors_total")
+        print("Writer Error:", error)
+
+        if errors is not None:
+            errors.append(error)
+
+        if stop_event is not None:
+            stop_event.set()
+
+        # Keep taking rows until the parsers finish, so they never block on a full queue.
+        while producers > 0:
+            if rows_queue.get() is SENTINEL:
+                producers -= 1
+
+        if errors is None:
+            raise
+
+
+if __name__ == "__main__":
+
+    main()
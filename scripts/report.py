@@ -0,0 +1,263 @@
+"""
+This module bundles the figures of step3.py into a single interactive HTML page.
+plotly.js is embedded once and every large value (the data arrays, the GeoJSON of the
+maps and the layout template) is saved once in a shared DATA table, the figures
+only keep references to it. The figures are drawn when they are scrolled into view.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import plotly.io as pio
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+
+REPORT_FILE = "report.html"
+
+# Values under these keys are always shared as a whole, they are big and repeated.
+SHARED_KEYS = ["geojson", "template"]
+
+# Smaller arrays are cheaper to keep inline than to reference.
+MIN_SHARED_BYTES = 200
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ background-color: #263238; margin: 0; }}
+.figure {{ margin: 20px auto; }}
+</style>
+{plotly_script}
+</head>
+<body>
+{divs}
+<script>
+const DATA = {data};
+const FIGURES = {figures};
+
+// Replaces every reference with the shared value, the same object is used by every figure.
+function resolve(value) {{
+    if (Array.isArray(value)) {{
+        return value.map(resolve);
+    }}
+    if (value !== null && typeof value === "object") {{
+        if (Object.keys(value).length === 1 && "$ref" in value) {{
+            return DATA[value["$ref"]];
+        }}
+        const resolved = {{}};
+        for (const key in value) {{
+            resolved[key] = resolve(value[key]);
+        }}
+        return resolved;
+    }}
+    return value;
+}}
+
+const observer = new IntersectionObserver(function (entries) {{
+    for (const entry of entries) {{
+        if (entry.isIntersecting) {{
+            const figure = FIGURES[entry.target.dataset.figure];
+            Plotly.newPlot(entry.target, resolve(figure.data), resolve(figure.layout));
+            observer.unobserve(entry.target);
+        }}
+    }}
+}}, {{rootMargin: "200px"}});
+
+for (const div of document.getElementsByClassName("figure")) {{
+    observer.observe(div);
+}}
+</script>
+</body>
+</html>
+"""
+
+
+def share_values(value, data, key=None):
+    """Moves the large values of a figure into the shared table, identical values are kept once.
+
+    Parameters
+    ----------
+    value : object
+        A JSON value of the figure.
+
+    data : dict
+        The shared table, keyed by the hash of each value.
+
+    key : str
+        The key of the value in its parent object.
+
+    Returns
+    -------
+    object
+        The value with the large parts replaced by references.
+
+    """
+
+    # plotly saves numpy arrays as typed arrays: {"dtype": ..., "bdata": ...}.
+    is_array = isinstance(value, list) and all(
+        not isinstance(item, (list, dict)) for item in value)
+    is_typed_array = isinstance(value, dict) and "bdata" in value
+
+    if key in SHARED_KEYS or is_array or is_typed_array:
+
+        serialized = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+        if key in SHARED_KEYS or len(serialized) >= MIN_SHARED_BYTES:
+            reference = hashlib.blake2b(serialized.encode("utf-8"), digest_size=8).hexdigest()
+            data[reference] = value
+
+            return {"$ref": reference}
+
+        return value
+
+    if isinstance(value, dict):
+        return {child_key: share_values(child, data, child_key) for child_key, child in value.items()}
+
+    if isinstance(value, list):
+        return [share_values(item, data) for item in value]
+
+    return value
+
+
+def export_report(figs, report_file=REPORT_FILE, title="Mexican Job Offers",
+                  include_plotlyjs="inline"):
+    """Saves the figures into a single HTML page.
+
+    Parameters
+    ----------
+    figs : list
+        The plotly.graph_objects.Figure objects, in the order they are shown.
+
+    report_file : str
+        The path of the HTML file.
+
+    title : str
+        The title of the page.
+
+    include_plotlyjs : str
+        inline to embed plotly.js, so the page works offline, or cdn to load it from the plotly CDN.
+
+    Returns
+    -------
+    dict
+        The number of figures, shared values and bytes of the page.
+
+    """
+
+    data = dict()
+    figures = list()
+
+    for fig in figs:
+        # to_json() converts the numpy arrays the same way write_html() does.
+        figure = json.loads(pio.to_json(fig, validate=False))
+        figures.append({"data": share_values(figure["data"], data),
+                        "layout": share_values(figure.get("layout", {}), data)})
+
+    if include_plotlyjs == "inline":
+        plotly_script = '<script type="text/javascript">{}</script>'.format(get_plotlyjs())
+    elif include_plotlyjs == "cdn":
+        plotly_script = '<script src="https://cdn.plot.ly/plotly-{}.min.js"></script>'.format(
+            get_plotlyjs_version())
+    else:
+        raise ValueError("include_plotlyjs must be inline or cdn")
+
+    # Each div keeps the size of its figure, so the page doesn't jump while they are drawn.
+    divs = "\n".join(
+        '<div class="figure" data-figure="{}" style="width: {}px; height: {}px;"></div>'.format(
+            number, figure["layout"].get("width", 1200), figure["layout"].get("height", 800))
+        for number, figure in enumerate(figures))
+
+    # </script> inside the JSON would close the script tag.
+    page = PAGE_TEMPLATE.format(
+        title=title, plotly_script=plotly_script, divs=divs,
+        data=json.dumps(data, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/"),
+        figures=json.dumps(figures, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/"))
+
+    with open(report_file, "w", encoding="utf-8") as temp_file:
+        temp_file.write(page)
+
+    print("Report Saved:", report_file)
+
+    return {"figures": len(figures), "shared_values": len(data),
+            "bytes": len(page.encode("utf-8"))}
+
+
+def benchmark(cube_file=None):
+    """Compares the size and generation time of the report against the PNG files
+    and against one standalone HTML file per figure.
+
+    Parameters
+    ----------
+    cube_file : str
+        Optional rollup cube, see step3.main().
+
+    """
+
+    import cube
+    import step3
+
+    df = step3.load_data()
+    rollup = cube.load_cube(cube_file) if cube_file is not None else None
+
+    def build_figures():
+        return [function(rollup if rollup is not None and name not in step3.RAW_FIGURES else df,
+                         file_name=None)
+                for name, function in step3.FIGURES.items()]
+
+    # The rows are printed at the end, export_report() prints its own messages.
+    results = list()
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        exports = [
+            ("PNG files", lambda fig, number: fig.write_image(
+                os.path.join(folder, "{}.png".format(number)))),
+            ("HTML file per figure", lambda fig, number: fig.write_html(
+                os.path.join(folder, "{}.html".format(number)), include_plotlyjs=True))
+        ]
+
+        for name, export in exports:
+
+            start_time = time.perf_counter()
+
+            try:
+                for number, fig in enumerate(build_figures(), 1):
+                    export(fig, number)
+            except Exception as error:
+                results.append("| {} | failed: {} | | |".format(name, type(error).__name__))
+                continue
+
+            seconds = time.perf_counter() - start_time
+            extension = ".png" if name == "PNG files" else ".html"
+            sizes = [os.path.getsize(os.path.join(folder, file_name))
+                     for file_name in os.listdir(folder) if file_name.endswith(extension)]
+
+            results.append("| {} | {} | {:,.0f} | {:.2f} |".format(
+                name, len(sizes), sum(sizes) / 1024, seconds))
+
+        for include_plotlyjs in ["inline", "cdn"]:
+
+            start_time = time.perf_counter()
+            stats = export_report(build_figures(),
+                                  os.path.join(folder, "report-{}.html".format(include_plotlyjs)),
+                                  include_plotlyjs=include_plotlyjs)
+            seconds = time.perf_counter() - start_time
+
+            results.append("| Report, plotly.js {} ({} shared values) | 1 | {:,.0f} | {:.2f} |".format(
+                include_plotlyjs, stats["shared_values"], stats["bytes"] / 1024, seconds))
+
+    print("| Export | Files | Size (KB) | Seconds |")
+    print("|---|---:|---:|---:|")
+
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+
+    benchmark()
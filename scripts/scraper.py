@@ -5,15 +5,27 @@ The job listings are downloaded into their respective state folder.
 
 import os
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import requests
 from selenium import webdriver
-from selenium.webdriver.support.ui import Select
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+import downloader
+import metrics
+
+# psutil is optional, without it the browser memory is not reported.
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 
 INITIAL_URL = "https://vun.empleo.gob.mx/contenido/publico/segob/oferta/busquedaOfertas.jsf"
 
@@ -56,7 +68,36 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:61.0) Gecko/20100101 Firefox/61.0"}
 
 ROOT_FOLDER = "./states/"
-DELTA_HOURS = 0  # 0 for local time, 5 for Mexico Central Time.
+
+# The listings are read from the HTML, so images, stylesheets, fonts and
+# analytics scripts are never downloaded. The JSF scripts are still needed.
+BLOCKED_URLS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico",
+                "*.css", "*.woff", "*.woff2", "*.ttf", "*.eot",
+                "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*"]
+
+# 2 means block in the Chrome content settings. Chrome has no such setting
+# for stylesheets, those are only blocked by BLOCKED_URLS.
+CHROME_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.fonts": 2,
+    "profile.managed_default_content_settings.plugins": 2,
+    "profile.managed_default_content_settings.popups": 2,
+    "profile.managed_default_content_settings.notifications": 2
+}
+
+WINDOW_SIZE = "1280,800"
+
+# The pages of results visited in each state.
+RESULTS_PAGES = 5
+
+# The seconds to wait for a page of results before using what is shown.
+RESULTS_TIMEOUT = 10
+
+LISTING_LINK = (By.PARTIAL_LINK_TEXT, "Ver vacante")
+
+# Chrome grows with every page, a new driver is started after this many pages.
+# It is only replaced between states, since the results pages depend on the search form.
+PAGES_PER_DRIVER = 50
 
 # Using a session greatly reduces timeouts and other errors.
 main_session = requests.Session()
@@ -67,41 +108,159 @@ main_session.mount(
 
 def main():
 
+    started_at = datetime.now()
+
+    try:
+        with metrics.profile("scraper"):
+            crawl()
+    finally:
+        metrics.write_report("scraper", started_at)
+
+
+def crawl(on_listing=None):
+    """Visits the first pages of results of each state and saves the new listings.
+
+    Parameters
+    ----------
+    on_listing : function
+        Optional function called with the state, file name, HTML text and download date
+        of every saved listing. It is used by pipeline.py to parse listings as they arrive.
+
+    """
+
     create_folders()
+    retry_queue = downloader.load_retry_queue()
     driver = create_driver()
+    driver_pages = 0
 
-    for state in STATES:
+    # The browser is closed even when a state fails or on_listing stops the crawl.
+    try:
+        for state in STATES:
+
+            if driver_pages >= PAGES_PER_DRIVER:
+                driver.quit()
+                driver = None
+                driver = create_driver()
+                driver_pages = 0
+                metrics.increment("scraper_driver_restarts_total")
+
+            driver_pages += crawl_state(driver, state, retry_queue, on_listing)
+            report_browser_memory(driver)
+    finally:
+        if driver is not None:
+            driver.quit()
+
+    # Retry the listings that failed on this or previous runs and are due.
+    downloader.process_retry_queue(
+        main_session, retry_queue,
+        on_saved=lambda log_name, text: save_listing(log_name, text, on_listing))
+
+
+def crawl_state(driver, state, retry_queue, on_listing=None):
+    """Searches the listings of a state and saves the new ones from the first pages of results.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver.Chrome
+        The browser.
+
+    state : str
+        The state name, as shown in the search form.
+
+    retry_queue : dict
+        The retry queue, see downloader.load_retry_queue().
+
+    on_listing : function
+        Optional function called for every saved listing, see crawl().
+
+    Returns
+    -------
+    int
+        The number of pages of results visited.
+
+    """
 
-        print("Checking:", state)
+    print("Checking:", state)
+
+    with metrics.timer("scraper_page_load_seconds", page="search"):
         driver.get(INITIAL_URL)
         states_select = Select(driver.find_element_by_id("domEntFed"))
         states_select.select_by_visible_text(state)
         driver.find_element_by_xpath("//input[@value='Buscar']").click()
+        links = driver.find_elements(*LISTING_LINK)
 
-        # Look at the first 5 pages of results.
-        for i in range(5):
+    for i in range(RESULTS_PAGES):
 
+        # The timer covers the click and the wait for the new results.
+        with metrics.timer("scraper_page_load_seconds", page="results"):
             driver.find_element_by_xpath(
                 "//input[@value='{}']".format(i+1)).click()
-            time.sleep(3)
+            links = wait_for_results(driver, links)
+
+        metrics.increment("scraper_pages_total")
+
+        # Iterate over each individual listing.
+        for link in links:
+            listing_url = link.get_attribute("href")
+            file_name = listing_url.split("=")[-1] + ".html"
+            metrics.increment("scraper_listings_seen_total")
+
+            # If the job listing is not already saved we save it.
+            if file_name not in os.listdir(ROOT_FOLDER + state):
+
+                full_path = "{}{}/{}".format(ROOT_FOLDER, state, file_name)
+                log_name = state + "/" + file_name
+
+                # A listing that failed before waits in the retry queue until its delay expires.
+                if downloader.is_waiting(retry_queue, full_path):
+                    metrics.increment("scraper_listings_backoff_total")
+                    continue
+
+                # Invalid responses are not saved, they go to the retry queue instead.
+                text = downloader.download_listing(
+                    main_session, listing_url, full_path, log_name, retry_queue)
+
+                if text is not None:
+                    save_listing(log_name, text, on_listing)
+                    print("Successfully Saved:", file_name)
+
+                time.sleep(0.5)
 
-            # Iterate over each individual listing.
-            for link in driver.find_elements_by_partial_link_text("Ver vacante"):
-                listing_url = link.get_attribute("href")
-                file_name = listing_url.split("=")[-1] + ".html"
+    return RESULTS_PAGES
 
-                # If the job listing is not already saved we save it.
-                if file_name not in os.listdir(ROOT_FOLDER + state):
 
-                    with main_session.get(listing_url, headers=HEADERS, verify=False) as response:
+def wait_for_results(driver, old_links):
+    """Waits until a page of results replaces the previous one and its listings are shown.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver.Chrome
+        The browser.
+
+    old_links : list
+        The listing links shown before the click, empty if there were none.
+
+    Returns
+    -------
+    list
+        The listing links of the new page, empty if it has none.
+
+    """
+
+    wait = WebDriverWait(driver, RESULTS_TIMEOUT)
 
-                        with open("{}{}/{}".format(ROOT_FOLDER, state, file_name), "w", encoding="utf-8") as temp_file:
-                            temp_file.write(response.text)
-                            update_log(state + "/" + file_name)
-                            print("Successfully Saved:", file_name)
-                            time.sleep(0.5)
+    # The old links are detached when the results are replaced.
+    if old_links:
+        try:
+            wait.until(expected_conditions.staleness_of(old_links[0]))
+        except TimeoutException:
+            metrics.increment("scraper_results_timeouts_total")
+            print("Results not refreshed after {} seconds".format(RESULTS_TIMEOUT))
 
-    driver.close()
+    try:
+        return wait.until(expected_conditions.presence_of_all_elements_located(LISTING_LINK))
+    except TimeoutException:
+        return list()
 
 
 def create_folders():
@@ -115,7 +274,7 @@ def create_folders():
 
 
 def create_driver():
-    """Creates a Selenium WebDriver instance."""
+    """Creates a Selenium WebDriver instance with a lean Chrome profile."""
 
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument("--disable-extensions")
@@ -124,27 +283,79 @@ def create_driver():
     chrome_options.add_argument("--log-level=3")
     chrome_options.add_argument("--headless")
 
+    # A fixed size instead of maximize_window(), which headless Chrome doesn't need.
+    chrome_options.add_argument("--window-size=" + WINDOW_SIZE)
+
+    # Only the JSF scripts are worth caching, blocked resources never reach the cache.
+    chrome_options.add_argument("--disk-cache-size=" + str(10 * 1024 * 1024))
+    chrome_options.add_argument("--media-cache-size=1")
+    chrome_options.add_argument("--disable-background-networking")
+    chrome_options.add_argument("--disable-default-apps")
+    chrome_options.add_argument("--disable-sync")
+    chrome_options.add_argument("--mute-audio")
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+    chrome_options.add_experimental_option("prefs", CHROME_PREFS)
+
     driver = webdriver.Chrome("./chromedriver.exe",
                               options=chrome_options)
-    driver.maximize_window()
     driver.implicitly_wait(10)
 
+    # The prefs don't cover every resource type, the rest is blocked by URL.
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+
     return driver
 
 
-def update_log(file_name):
-    """Updates the log file with the file name and the current timestamp.
+def report_browser_memory(driver):
+    """Records the resident memory of chromedriver and its Chrome processes.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver.Chrome
+        The driver to be measured.
+
+    """
+
+    if psutil is None:
+        return
+
+    try:
+        process = psutil.Process(driver.service.process.pid)
+        processes = [process] + process.children(recursive=True)
+        rss = sum(item.memory_info().rss for item in processes)
+    except psutil.Error:
+        return
+
+    metrics.observe("scraper_browser_rss_bytes", rss,
+                    buckets=[megabytes * 1024 * 1024
+                             for megabytes in [100, 200, 400, 800, 1600, 3200]])
+    print("Browser memory: {:,.1f} MB".format(rss / 1024 / 1024))
+
+
+def save_listing(log_name, text, on_listing=None):
+    """Logs a listing that was saved and passes it to the optional callback.
 
     Parameters
     ----------
-    file_name : str
-        The name of the file.
+    log_name : str
+        The name used in the log file (state/file_name).
+
+    text : str
+        The HTML document of the listing.
+
+    on_listing : function
+        Optional function called with the state, file name, HTML text and download date.
 
     """
 
-    with open("./log.txt", "a", encoding="utf-8") as temp_file:
-        now = datetime.now() - timedelta(hours=DELTA_HOURS)
-        temp_file.write("{},{}\n".format(file_name, now))
+    file_date = downloader.update_log(log_name)
+    metrics.observe("scraper_listing_bytes", len(text.encode("utf-8")),
+                    buckets=metrics.BYTES_BUCKETS)
+
+    if on_listing is not None:
+        state, file_name = log_name.split("/")
+        on_listing(state, file_name, text, file_date)
 
 
 if __name__ == "__main__":
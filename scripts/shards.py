@@ -0,0 +1,332 @@
+"""
+This module splits the extraction into shards that can run on different machines.
+Every logged file belongs to exactly one shard, decided by a hash of its listing id
+or of its state folder. Each worker parses its shard and saves a partial .csv file
+with a .json file that describes it. The merge reads every partial in the original
+log order and writes the same outputs as step2.py, reposts included.
+"""
+
+import contextlib
+import csv
+import hashlib
+import heapq
+import json
+import os
+import subprocess
+import sys
+import zlib
+from datetime import datetime
+
+import dedup
+import metrics
+import step2
+import store
+
+
+SHARDS_FOLDER = "./shards/"
+
+# The values that can be hashed to pick the shard of a file.
+SHARD_KEYS = ["listing", "state"]
+
+# The partial files have the position of each file in the log and its name before the row.
+PARTIAL_COLUMNS = ["position", "file_name"] + step2.COLUMNS[:-1]
+
+
+def manifest_hash(files_list):
+    """Hashes the list of logged files, so partials from different logs are never merged.
+
+    Parameters
+    ----------
+    files_list : list
+        The (file name, download date) tuples returned by step2.load_files().
+
+    Returns
+    -------
+    str
+        The hex digest.
+
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    for file_name, file_date in files_list:
+        digest.update("{},{}\n".format(file_name, file_date).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def shard_of(file_name, shards, key="listing"):
+    """Gets the shard of a file, the same on every machine and Python version.
+
+    Parameters
+    ----------
+    file_name : str
+        The path of the file, as returned by step2.load_files().
+
+    shards : int
+        The number of shards.
+
+    key : str
+        listing to spread the files evenly, state to keep each state in one shard.
+
+    Returns
+    -------
+    int
+        The shard number, from 0 to shards - 1.
+
+    """
+
+    if key == "listing":
+        value = dedup.listing_id(file_name)
+    elif key == "state":
+        value = file_name.split("/")[-2]
+    else:
+        raise ValueError("Unknown shard key: {}".format(key))
+
+    # crc32 is stable across processes, unlike hash() of a string.
+    return zlib.crc32(value.encode("utf-8")) % shards
+
+
+def partial_path(shards_folder, shard, shards):
+    """Gets the path of a partial output without its extension.
+
+    Parameters
+    ----------
+    shards_folder : str
+        The folder shared by the workers.
+
+    shard : int
+        The shard number.
+
+    shards : int
+        The number of shards.
+
+    Returns
+    -------
+    str
+        The path, .csv and .json are added to it.
+
+    """
+
+    return os.path.join(shards_folder, "shard-{:03d}-of-{:03d}".format(shard, shards))
+
+
+def run_shard(shard, shards, key="listing", shards_folder=SHARDS_FOLDER):
+    """Parses the files of a shard and saves its partial output.
+    The .json file is written last, so a partial without it is incomplete.
+
+    Parameters
+    ----------
+    shard : int
+        The shard number, from 0 to shards - 1.
+
+    shards : int
+        The number of shards.
+
+    key : str
+        The value hashed to pick the shard of each file, see shard_of().
+
+    shards_folder : str
+        The folder shared by the workers.
+
+    """
+
+    if not 0 <= shard < shards:
+        raise ValueError("The shard must be between 0 and {}".format(shards - 1))
+
+    started_at = datetime.now()
+    files_list = step2.load_files()
+    path = partial_path(shards_folder, shard, shards)
+    os.makedirs(shards_folder, exist_ok=True)
+
+    stats = {"shard": shard, "shards": shards, "key": key,
+             "manifest_hash": manifest_hash(files_list), "manifest_files": len(files_list),
+             "columns": PARTIAL_COLUMNS, "files": 0, "rows": 0, "failed": list(),
+             "started_at": str(started_at)}
+
+    try:
+        with metrics.profile("shard"):
+            with open(path + ".csv.tmp", "w", encoding="utf-8", newline="") as csv_file:
+
+                writer = csv.writer(csv_file)
+                writer.writerow(PARTIAL_COLUMNS)
+
+                # The log has each file once, so the file name gives back its position.
+                positions = {file_name: position
+                             for position, (file_name, _) in enumerate(files_list)
+                             if shard_of(file_name, shards, key) == shard}
+
+                shard_files = [item for item in files_list if item[0] in positions]
+                stats["files"] = len(shard_files)
+
+                # A broken file doesn't stop the shard, it is reported in the stats.
+                def on_error(file_name, error):
+                    stats["failed"].append([file_name, str(error)])
+                    metrics.increment("shard_files_failed_total")
+
+                for file_name, row in step2.parse_files(shard_files, on_error):
+                    writer.writerow((positions[file_name], file_name) + row)
+                    stats["rows"] += 1
+                    metrics.increment("shard_files_parsed_total")
+
+        os.replace(path + ".csv.tmp", path + ".csv")
+
+        stats["finished_at"] = str(datetime.now())
+
+        with open(path + ".json.tmp", "w", encoding="utf-8") as temp_file:
+            json.dump(stats, temp_file, ensure_ascii=False, indent=4)
+
+        os.replace(path + ".json.tmp", path + ".json")
+
+        print("Shard {} of {}: {:,} files, {:,} rows, {:,} failed".format(
+            shard, shards, stats["files"], stats["rows"], len(stats["failed"])))
+    finally:
+        metrics.write_report("shard-{:03d}".format(shard), started_at)
+
+
+def load_partials(shards_folder=SHARDS_FOLDER):
+    """Loads the stats of every partial and checks that they can be merged.
+
+    Parameters
+    ----------
+    shards_folder : str
+        The folder shared by the workers.
+
+    Returns
+    -------
+    list
+        The stats of each shard, sorted by shard number.
+
+    """
+
+    partials = list()
+
+    for file_name in sorted(os.listdir(shards_folder)):
+        if file_name.startswith("shard-") and file_name.endswith(".json"):
+            with open(os.path.join(shards_folder, file_name), "r", encoding="utf-8") as temp_file:
+                partials.append(json.load(temp_file))
+
+    if not partials:
+        raise ValueError("No partials found in: {}".format(shards_folder))
+
+    first = partials[0]
+
+    for stats in partials:
+        for field in ["shards", "key", "manifest_hash", "columns"]:
+            if stats[field] != first[field]:
+                raise ValueError("Shard {} has a different {}, it comes from another run".format(
+                    stats["shard"], field))
+
+    missing = set(range(first["shards"])) - {stats["shard"] for stats in partials}
+
+    if missing:
+        raise ValueError("Missing shards: {}".format(sorted(missing)))
+
+    # Every logged file must be in exactly one shard.
+    if sum(stats["files"] for stats in partials) != first["manifest_files"]:
+        raise ValueError("The shards don't cover the {:,} logged files".format(
+            first["manifest_files"]))
+
+    return sorted(partials, key=lambda stats: stats["shard"])
+
+
+def read_partial(temp_file):
+    """Reads the rows of a partial .csv file.
+
+    Parameters
+    ----------
+    temp_file : file
+        The open partial .csv file.
+
+    Returns
+    -------
+    generator
+        Tuples of (position, file name, row), the rows without duplicate_of.
+
+    """
+
+    reader = csv.reader(temp_file)
+    next(reader)
+
+    for values in reader:
+        yield int(values[0]), values[1], store.convert_row(values[2:])[:-1]
+
+
+def merge(shards_folder=SHARDS_FOLDER, **outputs):
+    """Merges the partials into data.csv and the optional outputs of step2.main().
+    The rows are merged by their position in the log, so the output and the reposts
+    found are the same as a single step2.py run.
+
+    Parameters
+    ----------
+    shards_folder : str
+        The folder shared by the workers.
+
+    outputs : str
+        The optional outputs accepted by step2.main(): database_file, cube_file,
+        dataset_folder and titles_file.
+
+    """
+
+    partials = load_partials(shards_folder)
+
+    with contextlib.ExitStack() as stack:
+
+        readers = [read_partial(stack.enter_context(open(
+            partial_path(shards_folder, stats["shard"], stats["shards"]) + ".csv",
+            "r", encoding="utf-8", newline=""))) for stats in partials]
+
+        # Each partial is already sorted by position, so a k-way merge restores the log order.
+        merged = ((file_name, row) for _, file_name, row
+                  in heapq.merge(*readers, key=lambda item: item[0]))
+
+        step2.main(parsed_rows=merged, **outputs)
+
+    for stats in partials:
+        for file_name, error in stats["failed"]:
+            print("Parse Error:", file_name, error)
+
+    print("Merged {} shards: {:,} rows, {:,} failed files".format(
+        len(partials), sum(stats["rows"] for stats in partials),
+        sum(len(stats["failed"]) for stats in partials)))
+
+
+def run_local(shards, key="listing", shards_folder=SHARDS_FOLDER, **outputs):
+    """Runs every shard in its own local process and merges the partials.
+
+    Parameters
+    ----------
+    shards : int
+        The number of shards and worker processes.
+
+    key : str
+        The value hashed to pick the shard of each file, see shard_of().
+
+    shards_folder : str
+        The folder shared by the workers.
+
+    outputs : str
+        The optional outputs accepted by step2.main().
+
+    """
+
+    os.makedirs(shards_folder, exist_ok=True)
+
+    # Partials from a previous run would fail the checks of the merge.
+    for file_name in os.listdir(shards_folder):
+        if file_name.startswith("shard-"):
+            os.remove(os.path.join(shards_folder, file_name))
+
+    entry_point = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mexican_jobs.py")
+
+    workers = [subprocess.Popen([sys.executable, entry_point, "shard", str(shard),
+                                 "--shards", str(shards), "--key", key,
+                                 "--folder", shards_folder])
+               for shard in range(shards)]
+
+    failed = [shard for shard, worker in enumerate(workers) if worker.wait() != 0]
+
+    if failed:
+        raise RuntimeError("Shards failed: {}".format(failed))
+
+    merge(shards_folder, **outputs)
@@ -3,14 +3,233 @@ This script extracts all the data required from the .html files and saves it int
 """
 
 import csv
+import re
+import time
+from datetime import datetime
 
 import lxml.html
 
+import columns
+import dedup
+import metrics
+import store
+
 
 # The next 2 lists must have the same length, since one will replace the other.
 ACCENT_MARKS = ["á", "Á", "é", "É", "í", "Í", "ó", "Ó", "ú", "Ú"]
 FRIENDLY_MARKS = ["a", "A", "e", "E", "i", "I", "o", "O", "u", "U"]
 
+COLUMNS = ["isodate", "offer", "salary", "contract_type", "start_hour",
+           "end_hour", "hours_worked", "monday", "tuesday", "wednesday",
+           "thursday", "friday", "saturday", "sunday", "days_worked",
+           "state", "municipality", "education_level", "experience", "languages",
+           "duplicate_of"]
+
+# What to do with reposted listings: "flag" keeps them and fills the duplicate_of
+# column with the id of the original listing, "skip" leaves them out of the dataset.
+DUPLICATES = "flag"
+
+# The start and end times of the working hours, like 08:30 a 17:00.
+SCHEDULE_PATTERN = re.compile(r"(\d{1,2}):(\d{2})\D+(\d{1,2}):(\d{2})")
+
+# The abbreviation of each weekday in the listings, in the same order as WEEKDAY_COLUMNS.
+WEEKDAY_CODES = ["L", "Ma", "Mi", "J", "V", "S", "D"]
+WEEKDAY_COLUMNS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# How many rows are held in memory before they are written, the schedule columns
+# of each batch are also derived together.
+BATCH_SIZE = 1000
+
+
+def main(database_file=None, cube_file=None, dataset_folder=None, titles_file=None,
+         parsed_rows=None):
+    """Parses all the logged files and saves the rows into data.csv and fingerprints.json.
+    The rows are written in batches as they are parsed, so the memory stays flat and
+    a run that dies halfway keeps what it already parsed.
+
+    Parameters
+    ----------
+    database_file : str
+        Optional SQLite database where the rows are also loaded, see store.py.
+
+    cube_file : str
+        Optional rollup cube that is rebuilt from the rows, see cube.py.
+
+    dataset_folder : str
+        Optional partitioned dataset that is rebuilt from the rows, see partitions.py.
+
+    titles_file : str
+        Optional index of the title words that is rebuilt from the rows, see titles.py.
+
+    parsed_rows : iterable
+        Optional (file name, row) tuples that were already parsed, in the same order
+        as load_files(). It is used by shards.py, the logged files are parsed when None.
+
+    """
+
+    started_at = datetime.now()
+
+    try:
+        with metrics.profile("step2"):
+
+            # Every logged file is checked again in order, so the fingerprints are rebuilt
+            # and fingerprints.json is replaced. Saved ones could hide reposts, since they
+            # were computed with the values of an older run.
+            index = dedup.create_index()
+            buffer = columns.ColumnBuffer(store.COLUMNS, store.COLUMN_TYPES.values())
+            offer_ids = list()
+            batch_number = 0
+
+            connection = store.connect(database_file) if database_file is not None else None
+
+            # Offers loaded by store.load_csv() have other ids, they would be counted twice.
+            if connection is not None and connection.execute(
+                    "SELECT 1 FROM offers WHERE listing_id LIKE 'csv:%' LIMIT 1").fetchone():
+                raise ValueError(
+                    "The database has offers loaded from a .csv file: " + database_file)
+
+            # Older runs keyed the offers by listing id only, they would be counted twice.
+            if connection is not None and connection.execute(
+                    "SELECT 1 FROM offers WHERE listing_id NOT LIKE '%/%' LIMIT 1").fetchone():
+                raise ValueError(
+                    "The database has offers without their state, delete it: " + database_file)
+
+            rollup = None
+
+            if cube_file is not None:
+
+                # Only imported when requested, like the other optional outputs.
+                import cube
+
+                # All the listings are parsed again, so the cube is rebuilt instead of updated.
+                rollup = cube.create_cube()
+
+            temp_folder = None
+
+            if dataset_folder is not None:
+
+                import partitions
+
+                # The dataset is written to a temporary folder and replaces the old one at the end.
+                temp_folder = partitions.start_dataset(dataset_folder)
+
+            title_index = None
+
+            if titles_file is not None:
+
+                import titles
+
+                # The row ids are the positions in data.csv, which is written again from the start.
+                title_index = titles.create_index()
+
+            with open("data.csv", "w", encoding="utf-8", newline="") as csv_file:
+
+                writer = csv.writer(csv_file)
+                writer.writerow(COLUMNS)
+
+                for file_name, row in parsed_rows if parsed_rows is not None else parse_files():
+                    row = flag_duplicate(index, file_name, row)
+
+                    if row is not None:
+                        buffer.append(row)
+                        offer_ids.append(store.offer_id(file_name))
+
+                    if len(buffer) == BATCH_SIZE:
+                        write_batch(buffer, offer_ids, writer, connection, rollup, temp_folder,
+                                    title_index, batch_number)
+                        csv_file.flush()
+                        batch_number += 1
+
+                write_batch(buffer, offer_ids, writer, connection, rollup, temp_folder,
+                            title_index, batch_number)
+
+            dedup.save_index(index)
+
+            if connection is not None:
+                connection.close()
+
+            if rollup is not None:
+                cube.save_cube(rollup, cube_file)
+
+            if temp_folder is not None:
+                partitions.finish_dataset(temp_folder, dataset_folder)
+
+            if title_index is not None:
+                titles.save_index(title_index, titles_file)
+    finally:
+        metrics.write_report("step2", started_at)
+
+
+def write_batch(buffer, offer_ids, writer, connection=None, rollup=None, dataset_folder=None,
+                title_index=None, batch_number=0):
+    """Writes a batch of rows to every output and empties it.
+
+    Parameters
+    ----------
+    buffer : columns.ColumnBuffer
+        The rows of the batch.
+
+    offer_ids : list
+        The offer id of each row, see store.offer_id().
+
+    writer : csv.writer
+        The writer of the .csv file.
+
+    connection : sqlite3.Connection
+        Optional database connection, see store.py.
+
+    rollup : dict
+        Optional rollup cube, see cube.py.
+
+    dataset_folder : str
+        Optional folder of a partitioned dataset, see partitions.py.
+
+    title_index : dict
+        Optional index of the title words, see titles.py.
+
+    batch_number : int
+        The position of the batch in data.csv, it names the files of the dataset.
+
+    """
+
+    if not buffer:
+        return
+
+    with metrics.timer("step2_write_seconds"):
+        writer.writerows(buffer.rows())
+
+    if connection is not None:
+        with metrics.timer("step2_database_seconds"):
+            store.insert_rows(connection, zip(offer_ids, buffer.rows()))
+
+    if rollup is not None:
+
+        import cube
+
+        with metrics.timer("step2_cube_seconds"):
+            cube.update_cube(rollup, buffer.rows())
+
+    if dataset_folder is not None:
+
+        import partitions
+
+        # The files are read back sorted by name, the padded number keeps the data.csv order.
+        with metrics.timer("step2_dataset_seconds"):
+            partitions.write_partitions(buffer, dataset_folder,
+                                        "part-{:05d}".format(batch_number))
+
+    if title_index is not None:
+
+        import titles
+
+        with metrics.timer("step2_titles_seconds"):
+            titles.add_rows(title_index, buffer.rows())
+
+    metrics.increment("step2_rows_written_total", len(buffer))
+
+    buffer.clear()
+    offer_ids.clear()
+
 
 def load_files():
     """Reads the log file and extracts all files paths."""
@@ -26,6 +245,62 @@ def load_files():
         return files_list
 
 
+def parse_files(files_list=None, on_error=None):
+    """Parses the logged files, the schedule columns are derived for each batch at once.
+
+    Parameters
+    ----------
+    files_list : list
+        The (file name, download date) tuples to parse, all the logged files by default.
+
+    on_error : function
+        Optional function called with the file name and the error of each file that
+        can't be parsed, the file is skipped. Errors are raised when None.
+
+    Returns
+    -------
+    generator
+        Tuples of (file name, row), the rows without duplicate_of.
+
+    """
+
+    files_list = files_list if files_list is not None else load_files()
+
+    for batch_start in range(0, len(files_list), BATCH_SIZE):
+
+        file_names = list()
+        raw_rows = list()
+
+        for file_name, file_date in files_list[batch_start:batch_start + BATCH_SIZE]:
+
+            try:
+                raw_rows.append(parse_file(file_name, file_date))
+                file_names.append(file_name)
+            except Exception as error:
+                if on_error is None:
+                    raise
+
+                on_error(file_name, error)
+
+        schedules = derive_schedules([raw_row[4] for raw_row in raw_rows],
+                                     [raw_row[5] for raw_row in raw_rows])
+
+        for file_name, raw_row, schedule in zip(file_names, raw_rows, schedules):
+
+            if schedule is None:
+                error = ValueError("Invalid schedule: {}".format(raw_row[4]))
+
+                if on_error is None:
+                    raise error
+
+                on_error(file_name, error)
+                continue
+
+            metrics.increment("step2_files_parsed_total")
+
+            yield file_name, build_row(raw_row, schedule)
+
+
 def parse_file(file_name, file_date):
     """Parses a .html file and extracts values of interest using lxml.
 
@@ -34,17 +309,49 @@ def parse_file(file_name, file_date):
     file_name : str
         The name of the file to be parsed.
 
+    file_date : str
+        The date and time when the file was downloaded.
+
+    Returns
+    -------
+    tuple
+        A raw row, see parse_html().
+
     """
 
     with open(file_name, "r", encoding="utf-8") as temp_file:
+        return parse_html(temp_file.read(), file_date)
+
+
+def parse_html(text, file_date):
+    """Extracts values of interest from the contents of a listing using lxml.
+
+    Parameters
+    ----------
+    text : str
+        The HTML document of the listing.
+
+    file_date : str
+        The date and time when the listing was downloaded.
+
+    Returns
+    -------
+    tuple
+        A raw row with the schedule and the work days as they appear in the listing,
+        build_row() turns it into a row with the same columns as COLUMNS.
+
+    """
+
+    with metrics.timer("step2_parse_seconds"):
 
         # Remove the time from from the file date.
         file_date = file_date.split()[0]
 
         # Parse the HTML document.
-        html = lxml.html.fromstring(temp_file.read())
+        html = lxml.html.fromstring(text)
 
-        name = html.xpath("//small[1]")[0].text.split("-")[0].lower().strip()
+        with metrics.timer("step2_xpath_seconds", field="Nombre"):
+            name = html.xpath("//small[1]")[0].text.split("-")[0].lower().strip()
 
         clean_words = list()
 
@@ -54,64 +361,330 @@ def parse_file(file_name, file_date):
 
         clean_name = clean_word(" ".join(clean_words))
 
-        salary = html.xpath(
-            "//strong[contains(text(),'Salario neto mensual:')]/following-sibling::span")[0].text.strip()
+        salary = get_field(html, "Salario neto mensual").strip()
 
         clean_salary = int(float(salary.replace("$", "").replace(",", "")))
 
-        hours = html.xpath(
-            "//strong[contains(text(),'Horario de trabajo:')]/following-sibling::span")[0].text.split()
-
-        start_hour = int(hours[0].replace(":", ""))
-        end_hour = int(hours[2].replace(":", ""))
-
-        if start_hour >= end_hour:
-            hours_worked = ((end_hour+2400) - start_hour) / 100
-        else:
-            hours_worked = (end_hour - start_hour) / 100
-
-        work_days = html.xpath(
-            "//strong[contains(text(),'Días laborales:')]/following-sibling::span")[0].text.strip()
+        # The schedule columns are derived later for the whole batch, see derive_schedules().
+        schedule = get_field(html, "Horario de trabajo").strip()
+        work_days = get_field(html, "Días laborales").strip()
 
-        monday = 1 if "L" in work_days else 0
-        tuesday = 1 if "Ma" in work_days else 0
-        wednesday = 1 if "Mi" in work_days else 0
-        thursday = 1 if "J" in work_days else 0
-        friday = 1 if "V" in work_days else 0
-        saturday = 1 if "S" in work_days else 0
-        sunday = 1 if "D" in work_days else 0
-
-        days_worked = monday + tuesday + wednesday + \
-            thursday + friday + saturday + sunday
-
-        location = html.xpath(
-            "//strong[contains(text(),'Ubicación:')]/following-sibling::span")[0].text.strip()
+        location = get_field(html, "Ubicación").strip()
 
         state, municipality = location.split(",")
 
-        education_level = html.xpath(
-            "//strong[contains(text(),'Estudios Solicitados:')]/following-sibling::div")[0].text.strip()
+        education_level = get_field(html, "Estudios Solicitados", "div").strip()
 
-        languages = html.xpath(
-            "//strong[contains(text(),'Idiomas:')]/following-sibling::div")[0].text.strip()
+        languages = get_field(html, "Idiomas", "div").strip()
 
         try:
-            experience = html.xpath(
-                "//strong[contains(text(),'Experiencia:')]/following-sibling::div")[0].text.strip()
+            experience = get_field(html, "Experiencia", "div").strip()
         except:
             experience = "No especificada"
 
         try:
-            contract_type = html.xpath(
-                "//strong[contains(text(),'Tipo de contrato:')]/following-sibling::span")[0].text.strip()
+            contract_type = get_field(html, "Tipo de contrato").strip()
         except:
             contract_type = "No especificado"
 
-        data_list.append((file_date, clean_name, clean_salary, contract_type,
-                          start_hour, end_hour, hours_worked, monday, tuesday,
-                          wednesday, thursday, friday, saturday, sunday, days_worked,
-                          state.strip(), municipality.strip(), education_level, experience,
-                          languages))
+        return (file_date, clean_name, clean_salary, contract_type, schedule, work_days,
+                state.strip(), municipality.strip(), education_level, experience,
+                languages)
+
+
+def build_row(raw_row, schedule):
+    """Replaces the schedule and the work days of a raw row with the derived columns.
+
+    Parameters
+    ----------
+    raw_row : tuple
+        A raw row, see parse_html().
+
+    schedule : tuple
+        The derived columns, see derive_schedule().
+
+    Returns
+    -------
+    tuple
+        A row with the values in the same order as COLUMNS, without duplicate_of.
+
+    """
+
+    return raw_row[:4] + schedule + raw_row[6:]
+
+
+def derive_schedule(schedule, work_days):
+    """Derives the schedule columns of a single listing, used when listings arrive one by one.
+
+    Parameters
+    ----------
+    schedule : str
+        The working hours, like 08:30 a 17:00.
+
+    work_days : str
+        The abbreviated work days, like L, Ma, Mi, J, V.
+
+    Returns
+    -------
+    tuple
+        The start hour, end hour, hours worked, one flag for each weekday and the days worked.
+
+    """
+
+    match = SCHEDULE_PATTERN.search(schedule)
+
+    if match is None:
+        raise ValueError("Invalid schedule: {}".format(schedule))
+
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+
+    start_minutes = start_hour * 60 + start_minute
+    end_minutes = end_hour * 60 + end_minute
+
+    # A shift that ends at or before its start time ends on the next day.
+    if end_minutes <= start_minutes:
+        end_minutes += 24 * 60
+
+    hours_worked = round((end_minutes - start_minutes) / 60, 2)
+    flags = tuple(1 if day in work_days else 0 for day in WEEKDAY_CODES)
+
+    return (start_hour * 100 + start_minute, end_hour * 100 + end_minute,
+            hours_worked) + flags + (sum(flags),)
+
+
+def derive_schedules(schedules, work_days):
+    """Derives the schedule columns of a batch of listings in a single vectorized pass.
+    It gives the same values as derive_schedule().
+
+    Parameters
+    ----------
+    schedules : list
+        The working hours of each listing.
+
+    work_days : list
+        The abbreviated work days of each listing.
+
+    Returns
+    -------
+    list
+        The derived columns of each listing, see derive_schedule().
+        None for the schedules that can't be parsed.
+
+    """
+
+    if not schedules:
+        return list()
+
+    # numpy is only needed to extract the logged files, not by the pipeline.
+    import numpy as np
+
+    # Listings repeat a few schedules, so each distinct value is parsed once and the
+    # results are spread to every row with the codes.
+    schedule_codes = dict()
+    day_codes = dict()
+    schedule_rows = np.array([schedule_codes.setdefault(schedule, len(schedule_codes))
+                              for schedule in schedules])
+    day_rows = np.array([day_codes.setdefault(days, len(day_codes)) for days in work_days])
+
+    matches = [SCHEDULE_PATTERN.search(schedule) for schedule in schedule_codes]
+    valid = np.array([match is not None for match in matches])[schedule_rows]
+    times = np.array([list(map(int, match.groups())) if match is not None else [0, 0, 0, 0]
+                      for match in matches], dtype=np.int64)[schedule_rows]
+
+    start_minutes = times[:, 0] * 60 + times[:, 1]
+    end_minutes = times[:, 2] * 60 + times[:, 3]
+
+    # A shift that ends at or before its start time ends on the next day.
+    end_minutes = np.where(end_minutes <= start_minutes, end_minutes + 24 * 60, end_minutes)
+
+    flags = np.array([[1 if day in days else 0 for day in WEEKDAY_CODES]
+                      for days in day_codes], dtype=np.int64)[day_rows]
+
+    derived_columns = zip(
+        (times[:, 0] * 100 + times[:, 1]).tolist(),
+        (times[:, 2] * 100 + times[:, 3]).tolist(),
+        np.round((end_minutes - start_minutes) / 60, 2).tolist(),
+        *flags.T.tolist(),
+        flags.sum(axis=1).tolist())
+
+    return [columns_values if is_valid else None
+            for columns_values, is_valid in zip(derived_columns, valid)]
+
+
+def fix_schedules(csv_file="data.csv", cube_file=None, dataset_folder=None, titles_file=None):
+    """Recomputes hours_worked and days_worked of an existing .csv file from its
+    start_hour, end_hour and weekday columns, without parsing the listings again.
+    Files made before the hours were computed with minute precision need it.
+
+    The cube, the dataset and the title index are rebuilt from the fixed file.
+    The database and fingerprints.json are keyed by listing ids, which the file
+    doesn't have, so they keep the old values until main() runs again.
+
+    Parameters
+    ----------
+    csv_file : str
+        The path of the .csv file.
+
+    cube_file : str
+        Optional rollup cube that is rebuilt from the fixed file, see cube.py.
+
+    dataset_folder : str
+        Optional partitioned dataset that is rebuilt from the fixed file, see partitions.py.
+
+    titles_file : str
+        Optional index of the title words that is rebuilt from the fixed file, see titles.py.
+
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    df = pd.read_csv(csv_file, keep_default_na=False, dtype=str)
+
+    start_hour = df["start_hour"].astype(np.int64).to_numpy()
+    end_hour = df["end_hour"].astype(np.int64).to_numpy()
+
+    start_minutes = start_hour // 100 * 60 + start_hour % 100
+    end_minutes = end_hour // 100 * 60 + end_hour % 100
+    end_minutes = np.where(end_minutes <= start_minutes, end_minutes + 24 * 60, end_minutes)
+
+    df["hours_worked"] = np.round((end_minutes - start_minutes) / 60, 2)
+    df["days_worked"] = df[WEEKDAY_COLUMNS].astype(np.int64).sum(axis=1)
+
+    df.to_csv(csv_file, index=False)
+    print("Schedules Fixed:", csv_file)
+
+    if cube_file is not None:
+
+        import cube
+
+        cube.save_cube(cube.build_from_csv(csv_file), cube_file)
+
+    if dataset_folder is not None:
+
+        import partitions
+
+        partitions.build_from_csv(csv_file, dataset_folder)
+
+    if titles_file is not None:
+
+        import titles
+
+        titles.save_index(titles.build_from_csv(csv_file), titles_file)
+
+    print("The database and fingerprints.json still have the old hours, "
+          "extract the dataset again to rebuild them.")
+
+
+def benchmark(csv_file=store.SAMPLE_FILE, scale=100):
+    """Compares derive_schedules() against calling derive_schedule() for each row.
+
+    Parameters
+    ----------
+    csv_file : str
+        The .csv file used to rebuild the raw schedules.
+
+    scale : int
+        How many copies of its schedules are derived.
+
+    """
+
+    rows = list(store.read_rows(csv_file))
+    start_position = COLUMNS.index("start_hour")
+    weekday_positions = [COLUMNS.index(column) for column in WEEKDAY_COLUMNS]
+
+    # The raw strings as they appear in the listings.
+    schedules = ["{:02d}:{:02d} a {:02d}:{:02d}".format(
+        start // 100, start % 100, end // 100, end % 100)
+        for start, end in (row[start_position:start_position + 2] for row in rows)] * scale
+
+    work_days = [", ".join(code for code, position in zip(WEEKDAY_CODES, weekday_positions)
+                           if row[position])
+                 for row in rows] * scale
+
+    start_time = time.perf_counter()
+    per_row = [derive_schedule(schedule, days) for schedule, days in zip(schedules, work_days)]
+    per_row_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batch = list()
+
+    for batch_start in range(0, len(schedules), BATCH_SIZE):
+        batch.extend(derive_schedules(schedules[batch_start:batch_start + BATCH_SIZE],
+                                      work_days[batch_start:batch_start + BATCH_SIZE]))
+
+    batch_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    derive_schedules(schedules, work_days)
+    single_pass_seconds = time.perf_counter() - start_time
+
+    assert per_row == batch
+
+    print("| Method | Rows | Seconds | Rows per second |")
+    print("|---|---:|---:|---:|")
+
+    for name, seconds in [("derive_schedule() per row", per_row_seconds),
+                          ("derive_schedules() in batches of {:,}".format(BATCH_SIZE),
+                           batch_seconds),
+                          ("derive_schedules() in a single pass", single_pass_seconds)]:
+        print("| {} | {:,} | {:.3f} | {:,.0f} |".format(
+            name, len(schedules), seconds, len(schedules) / seconds))
+
+
+def flag_duplicate(index, file_name, row):
+    """Adds the duplicate_of column to the row.
+
+    Parameters
+    ----------
+    index : dict
+        The fingerprints index, as returned by dedup.load_index().
+
+    file_name : str
+        The name of the parsed file.
+
+    row : tuple
+        A row as returned by parse_html().
+
+    Returns
+    -------
+    tuple
+        The complete row, None if it is a duplicate and DUPLICATES is "skip".
+
+    """
+
+    duplicate_of = dedup.check(index, dedup.listing_id(file_name), row)
+
+    if duplicate_of and DUPLICATES == "skip":
+        return None
+
+    return row + (duplicate_of,)
+
+
+def get_field(html, label, tag="span"):
+    """Gets the text of the element that follows the specified label.
+
+    Parameters
+    ----------
+    html : lxml.html.HtmlElement
+        The parsed HTML document.
+
+    label : str
+        The text of the label, without the trailing colon.
+
+    tag : str
+        The tag of the element that contains the value.
+
+    Returns
+    -------
+    str
+        The text of the value element.
+
+    """
+
+    with metrics.timer("step2_xpath_seconds", field=label):
+        return html.xpath(
+            "//strong[contains(text(),'{}:')]/following-sibling::{}".format(label, tag))[0].text
 
 
 def clean_word(word):
@@ -137,15 +710,4 @@ def clean_word(word):
 
 if __name__ == "__main__":
 
-    # We use multithreading to accelerate the reading of all files.
-    data_list = list()
-    data_list.append(["isodate", "offer", "salary", "contract_type", "start_hour",
-                      "end_hour", "hours_worked", "monday", "tuesday", "wednesday",
-                      "thursday", "friday", "saturday", "sunday", "days_worked",
-                      "state", "municipality", "education_level", "experience", "languages"])
-
-    for file_name, file_date in load_files():
-        parse_file(file_name, file_date)
-
-    with open("data.csv", "w", encoding="utf-8", newline="") as csv_file:
-        csv.writer(csv_file).writerows(data_list)
+    main()
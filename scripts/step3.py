@@ -2,30 +2,200 @@
 Functions used to generate the EDA on the mexican job offers dataset.
 """
 
+import functools
 import json
+import sys
 from datetime import datetime
 
 import pandas as pd
 import plotly.graph_objects as go
 
+import cube
+import metrics
 
-def days_stats(df):
+
+def count_by(data, column):
+    """Counts the job offers by the values of a column.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    column : str
+        The column name, weekday is derived from isodate.
+
+    Returns
+    -------
+    pandas.Series
+        The counts sorted in descending order, like value_counts().
+
+    """
+
+    if isinstance(data, pd.DataFrame):
+
+        if column == "weekday":
+            return data["isodate"].dt.weekday.value_counts()
+
+        return data[column].value_counts()
+
+    counts = pd.Series(cube.counts_by(data, column), name=column)
+
+    if column == "isodate":
+        counts.index = pd.to_datetime(counts.index)
+
+    return counts.sort_values(ascending=False)
+
+
+def median_salary_by(data, column):
+    """Gets the median salary for each value of a column.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    column : str
+        The column name.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A DataFrame with a salary column sorted in descending order.
+
+    """
+
+    if isinstance(data, pd.DataFrame):
+        medians = data.pivot_table(index=column, values="salary", aggfunc="median")
+    else:
+        medians = pd.DataFrame({"salary": pd.Series(cube.median_salary_by(data, column))})
+
+    return medians.sort_values("salary", ascending=False)
+
+
+def histogram_trace(data, column, max_value=None, **kwargs):
+    """Creates an Histogram trace, from the raw values or from the counts of each value.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    column : str
+        The column name.
+
+    max_value : float
+        Values greater than this one are left out.
+
+    kwargs : object
+        Additional arguments for the trace.
+
+    Returns
+    -------
+    plotly.graph_objects.Histogram
+        The Histogram trace.
+
+    """
+
+    if isinstance(data, pd.DataFrame):
+        values = data[column]
+
+        if max_value is not None:
+            values = values[values <= max_value]
+
+        return go.Histogram(x=values, **kwargs)
+
+    if column == "salary":
+        counts = cube.salary_histogram(data)
+    else:
+        counts = cube.counts_by(data, column)
+
+    if max_value is not None:
+        counts = {value: count for value, count in counts.items() if value <= max_value}
+
+    # Summing the counts of each value gives the same bars as the raw values.
+    return go.Histogram(x=list(counts), y=list(counts.values()), histfunc="sum", **kwargs)
+
+
+def describe_salaries(data):
+    """Gets the summary statistics of the salaries.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    Returns
+    -------
+    pandas.Series
+        The count, mean, minimum, quartiles and maximum.
+
+    """
+
+    if isinstance(data, pd.DataFrame):
+        return data["salary"].describe()
+
+    return pd.Series(cube.salary_summary(data), name="salary")
+
+
+def save_figure(fig, file_name):
+    """Renders the figure to an image file and records the render time.
+
+    Parameters
+    ----------
+    fig : plotly.graph_objects.Figure
+        The figure to be saved.
+
+    file_name : str
+        The name of the image file.
+
+    """
+
+    with metrics.timer("step3_render_seconds", figure=file_name):
+        fig.write_image(file_name)
+
+    metrics.increment("step3_figures_rendered_total")
+
+
+@functools.lru_cache(maxsize=None)
+def load_geojson():
+    """Loads the GeoJSON of the Mexican states once, both maps use the same object.
+
+    Returns
+    -------
+    dict
+        The GeoJSON.
+
+    """
+
+    return json.loads(open("mexico.json", "r", encoding="utf-8").read())
+
+
+def days_stats(df, file_name="1.png"):
     """Gets the daily counts by weekday and plots the daily counts.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
-    weekdays = df["isodate"].dt.weekday.value_counts()
+    weekdays = count_by(df, "weekday")
     weekdays.sort_index(inplace=True)
 
     print(weekdays.to_markdown(floatfmt=",.0f"))
 
     # Create a Series with the counts of each day.
-    days_counts = df["isodate"].value_counts()
+    days_counts = count_by(df, "isodate")
     days_counts.sort_index(inplace=True)
 
     # Create a new DataFrame with only the data of Mondays.
@@ -64,27 +234,36 @@ def days_stats(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("1.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
 
+    return fig
 
-def salaries_stats(df):
+
+def salaries_stats(df, file_name="2.png"):
     """Plots the salaries distribution in an Histograms.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
 
-    """
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
-    print(df["salary"].describe().to_markdown(floatfmt=",.0f"))
+    """
 
-    salaries = df[df["salary"] <= 35000]
+    print(describe_salaries(df).to_markdown(floatfmt=",.0f"))
 
     fig = go.Figure()
 
-    fig.add_traces(go.Histogram(
-        x=salaries["salary"], nbinsx=35, marker_color="#ffa000"))
+    fig.add_traces(histogram_trace(
+        df, "salary", max_value=35000, nbinsx=35, marker_color="#ffa000"))
 
     fig.update_xaxes(title="Monthly Salary", ticks="outside", ticklen=10, gridwidth=0.5,
                      tickcolor="#FFFFFF", linewidth=2, showline=True, mirror=True, nticks=35, title_standoff=20)
@@ -109,20 +288,31 @@ def salaries_stats(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("2.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def plot_states_offers(df):
+def plot_states_offers(df, file_name="3.png"):
     """Plots the job offers distribution in av horizontal Bar plot.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
-    states_series = df["state"].value_counts()
+    states_series = count_by(df, "state")
 
     fig = go.Figure()
 
@@ -156,22 +346,33 @@ def plot_states_offers(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("3.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
 
+    return fig
 
-def plot_states_map(df):
+
+def plot_states_map(df, file_name="4.png"):
     """Plots the job offers distribution in a Choropleth map.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
-    states_series = df["state"].value_counts()
+    states_series = count_by(df, "state")
 
-    geojson = json.loads(open("mexico.json", "r", encoding="utf-8").read())
+    geojson = load_geojson()
 
     fig = go.Figure()
 
@@ -207,21 +408,31 @@ def plot_states_map(df):
         paper_bgcolor="#37474f",
     )
 
-    fig.write_image("4.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
 
+    return fig
 
-def plot_states_median_salary(df):
+
+def plot_states_median_salary(df, file_name="5.png"):
     """Plots the median salary in each state using an horizontal Bar chart.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
-    median_salaries = df.pivot_table(
-        index="state", values="salary", aggfunc="median").sort_values("salary", ascending=False)
+    median_salaries = median_salary_by(df, "state")
 
     fig = go.Figure()
 
@@ -255,23 +466,33 @@ def plot_states_median_salary(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("5.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def plot_median_salary_map(df):
+def plot_median_salary_map(df, file_name="6.png"):
     """Plots the median salary by state in a Choropleth map.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
-    median_salaries = df.pivot_table(
-        index="state", values="salary", aggfunc="median").sort_values("salary", ascending=False)
+    median_salaries = median_salary_by(df, "state")
 
-    geojson = json.loads(open("mexico.json", "r", encoding="utf-8").read())
+    geojson = load_geojson()
 
     fig = go.Figure()
 
@@ -308,22 +529,33 @@ def plot_median_salary_map(df):
         paper_bgcolor="#37474f",
     )
 
-    fig.write_image("6.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def plot_hours(df):
+def plot_hours(df, file_name="7.png"):
     """Plots the hours required to work in an Histogram.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
     fig = go.Figure()
 
-    fig.add_traces(go.Histogram(x=df["hours_worked"],  marker_color="#ffa000"))
+    fig.add_traces(histogram_trace(df, "hours_worked", marker_color="#ffa000"))
 
     fig.update_xaxes(title="Hours Required", ticks="outside", ticklen=10,  gridwidth=0.5,
                      tickcolor="#FFFFFF", linewidth=2, showline=True, mirror=True, nticks=35, title_standoff=20)
@@ -348,22 +580,33 @@ def plot_hours(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("7.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
 
+    return fig
 
-def plot_days(df):
+
+def plot_days(df, file_name="8.png"):
     """Plots the days required to work in an Histogram.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
     fig = go.Figure()
 
-    fig.add_traces(go.Histogram(x=df["days_worked"], marker_color="#ffa000"))
+    fig.add_traces(histogram_trace(df, "days_worked", marker_color="#ffa000"))
 
     fig.update_xaxes(title="Days Required", ticks="outside", ticklen=10,  gridwidth=0.5,
                      tickcolor="#FFFFFF", linewidth=2, showline=True, mirror=True, nticks=35, title_standoff=20)
@@ -387,16 +630,27 @@ def plot_days(df):
         plot_bgcolor="#37474f"
     )
 
-    fig.write_image("8.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def plot_education_level(df):
+def plot_education_level(df, file_name="9.png"):
     """Plots the education level distribution in a Donut plot.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
@@ -404,7 +658,7 @@ def plot_education_level(df):
     colors = ["#0091ea", "#ff5722", "#43a047", "#7e57c2", "#1565c0",
               "#2e7d32", "#c62828", "#ef6c00", "#ffc400", "#64dd17"]
 
-    education_level = df["education_level"].value_counts()
+    education_level = count_by(df, "education_level")
 
     fig = go.Figure()
 
@@ -432,16 +686,27 @@ def plot_education_level(df):
         paper_bgcolor="#37474f"
     )
 
-    fig.write_image("9.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def plot_experience(df):
+def plot_experience(df, file_name="10.png"):
     """Plots the experience distribution in a Donut plot.
 
     Parameters
     ----------
-    df : pandas.DataFrame
-        A pandas DataFrame containing job offers data.
+    df : pandas.DataFrame or dict
+        A pandas DataFrame containing job offers data or a rollup cube.
+
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
 
     """
 
@@ -449,7 +714,7 @@ def plot_experience(df):
     colors = ["#0091ea", "#ff5722", "#43a047", "#7e57c2", "#1565c0",
               "#2e7d32", "#c62828", "#ef6c00", "#ffc400", "#64dd17"]
 
-    experience = df["experience"].value_counts()
+    experience = count_by(df, "experience")
 
     fig = go.Figure()
 
@@ -477,10 +742,13 @@ def plot_experience(df):
         paper_bgcolor="#37474f"
     )
 
-    fig.write_image("10.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def hours_worked_salary(df):
+def hours_worked_salary(df, file_name="11.png"):
     """Plots the correlation between salary and daily hours worked in a Scatter plot.
 
     Parameters
@@ -488,6 +756,14 @@ def hours_worked_salary(df):
     df : pandas.DataFrame
         A pandas DataFrame containing job offers data.
 
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
+
     """
 
     # Remove outliers.
@@ -522,10 +798,13 @@ def hours_worked_salary(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("11.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
 
 
-def education_level_salary(df):
+def education_level_salary(df, file_name="12.png"):
     """Plots the correlation between salary and education level in a Scatter plot.
 
     Parameters
@@ -533,6 +812,14 @@ def education_level_salary(df):
     df : pandas.DataFrame
         A pandas DataFrame containing job offers data.
 
+    file_name : str
+        The name of the image file, the figure is only returned when None.
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+        The figure.
+
     """
 
     # Remove outliers.
@@ -586,22 +873,169 @@ def education_level_salary(df):
         plot_bgcolor="#263238"
     )
 
-    fig.write_image("12.png")
+    if file_name is not None:
+        save_figure(fig, file_name)
+
+    return fig
+
+
+def main(figures, cube_file=None, dataset_folder=None, start_date=None, end_date=None,
+         states=None, report_file=None):
+    """Loads the dataset and renders the specified figures.
+
+    Parameters
+    ----------
+    figures : list
+        The names of the figure functions to run, see FIGURES.
+
+    cube_file : str
+        Optional rollup cube used instead of the dataset, see cube.py.
+        The figures in RAW_FIGURES still load the dataset, like the ones in
+        CELL_LESS_FIGURES when there are filters.
+
+    dataset_folder : str
+        Optional partitioned dataset used instead of data.csv, see partitions.py.
+
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    states : list
+        The states to include, all of them by default.
+
+    report_file : str
+        Optional HTML file where the figures are saved together instead of as images, see report.py.
+
+    """
+
+    # A misspelled name is reported before the dataset is loaded.
+    unknown = [name for name in figures if name not in FIGURES]
+
+    if unknown:
+        raise ValueError("Unknown figures: {}. The figures are: {}".format(
+            ", ".join(unknown), ", ".join(FIGURES)))
+
+    started_at = datetime.now()
+
+    try:
+        with metrics.profile("step3"):
+
+            df = None
+            rollup = None
+            figs = list()
+
+            # With a report the figures are only built, they are saved at the end.
+            file_names = {"file_name": None} if report_file is not None else {}
+
+            filtered = start_date is not None or end_date is not None or states is not None
+
+            if cube_file is not None:
+                with metrics.timer("step3_load_seconds", source="cube"):
+                    rollup = cube.load_cube(cube_file)
+
+                if filtered:
+                    rollup = cube.filter_cube(rollup, start_date, end_date, states)
+
+            for name in figures:
+
+                # The filtered cube has no days and hours worked rollups.
+                if rollup is not None and name not in RAW_FIGURES and not (
+                        filtered and name in CELL_LESS_FIGURES):
+                    figs.append(FIGURES[name](rollup, **file_names))
+                    continue
+
+                if df is None:
+                    df = load_data(dataset_folder, start_date, end_date, states)
+
+                figs.append(FIGURES[name](df, **file_names))
+
+            if report_file is not None:
+
+                # Only imported when requested, like the other optional outputs.
+                import report
+
+                with metrics.timer("step3_report_seconds"):
+                    report.export_report(figs, report_file)
+    finally:
+        metrics.write_report("step3", started_at)
+
+
+def load_data(dataset_folder=None, start_date=None, end_date=None, states=None):
+    """Loads the dataset without the reposted listings.
+
+    Parameters
+    ----------
+    dataset_folder : str
+        Optional partitioned dataset, only the partitions that match the filters are read.
+        data.csv is used when None.
+
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    states : list
+        The states to include, all of them by default.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A pandas DataFrame containing job offers data.
+
+    """
+
+    if dataset_folder is not None:
+
+        # pyarrow is only needed when the partitioned dataset is used.
+        import partitions
+
+        with metrics.timer("step3_load_seconds", source="dataset"):
+            df = partitions.load_dataset(dataset_folder, start_date, end_date, states)
+    else:
+        with metrics.timer("step3_load_seconds", source="csv"):
+            df = pd.read_csv("data.csv", parse_dates=["isodate"])
+
+        if start_date is not None:
+            df = df[df["isodate"] >= start_date]
+
+        if end_date is not None:
+            df = df[df["isodate"] <= end_date]
+
+        if states is not None:
+            df = df[df["state"].isin(states)]
+
+    # Reposted listings would inflate the counts, older files don't have this column.
+    if "duplicate_of" in df.columns:
+        df = df[df["duplicate_of"].isna()]
+
+    return df
+
+
+# The scatter plots need every offer, they can't be drawn from the cube.
+RAW_FIGURES = ["hours_worked_salary", "education_level_salary"]
+
+# The cells of the cube don't have the days and hours worked, these figures can't be filtered.
+CELL_LESS_FIGURES = ["plot_hours", "plot_days"]
+
+FIGURES = {function.__name__: function for function in [
+    days_stats,
+    salaries_stats,
+    plot_states_offers,
+    plot_states_map,
+    plot_states_median_salary,
+    plot_median_salary_map,
+    plot_hours,
+    plot_days,
+    plot_education_level,
+    plot_experience,
+    hours_worked_salary,
+    education_level_salary
+]}
 
 
 if __name__ == "__main__":
 
-    df = pd.read_csv("data.csv", parse_dates=["isodate"])
-
-    # days_stats(df)
-    # salaries_stats(df)
-    # plot_states_offers(df)
-    # plot_states_map(df)
-    # plot_states_median_salary(df)
-    # plot_median_salary_map(df)
-    # plot_hours(df)
-    # plot_days(df)
-    # plot_education_level(df)
-    # plot_experience(df)
-    # hours_worked_salary(df)
-    # education_level_salary(df)
+    main(sys.argv[1:] or FIGURES)
@@ -0,0 +1,570 @@
+"""
+This module keeps the extracted job offers in an indexed SQLite database and provides
+a small query API, so questions about a subset of the offers don't require loading
+the whole .csv file.
+"""
+
+import csv
+import os
+import sqlite3
+import tempfile
+import time
+
+
+DATABASE_FILE = "./jobs.db"
+
+# The August 2020 dataset shipped with the repository, used as seed by the benchmarks.
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "data.csv")
+
+# Same order as step2.COLUMNS.
+COLUMN_TYPES = {
+    "isodate": "TEXT",
+    "offer": "TEXT",
+    "salary": "INTEGER",
+    "contract_type": "TEXT",
+    "start_hour": "INTEGER",
+    "end_hour": "INTEGER",
+    "hours_worked": "REAL",
+    "monday": "INTEGER",
+    "tuesday": "INTEGER",
+    "wednesday": "INTEGER",
+    "thursday": "INTEGER",
+    "friday": "INTEGER",
+    "saturday": "INTEGER",
+    "sunday": "INTEGER",
+    "days_worked": "INTEGER",
+    "state": "TEXT",
+    "municipality": "TEXT",
+    "education_level": "TEXT",
+    "experience": "TEXT",
+    "languages": "TEXT",
+    "duplicate_of": "TEXT"
+}
+
+COLUMNS = list(COLUMN_TYPES)
+
+CONVERTERS = {"INTEGER": int, "REAL": float, "TEXT": str}
+
+INDEXED_COLUMNS = ["isodate", "state", "municipality", "education_level", "salary"]
+
+# The columns that can be used in group_counts(), group_medians() and top_titles().
+GROUP_COLUMNS = ["isodate", "state", "municipality", "education_level", "experience",
+                 "contract_type", "days_worked", "languages", "offer"]
+
+
+def connect(database_file=DATABASE_FILE):
+    """Opens the database and creates the table and its indexes if they don't exist.
+
+    Parameters
+    ----------
+    database_file : str
+        The path of the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+        The database connection.
+
+    """
+
+    connection = sqlite3.connect(database_file)
+
+    columns = ", ".join("{} {}".format(column, COLUMN_TYPES[column])
+                        for column in COLUMNS)
+
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS offers (listing_id TEXT PRIMARY KEY, {})".format(columns))
+
+    for column in INDEXED_COLUMNS:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS offers_{0} ON offers ({0})".format(column))
+
+    # Most questions filter by state and education level within a date range.
+    connection.execute("CREATE INDEX IF NOT EXISTS offers_state_education_date "
+                       "ON offers (state, education_level, isodate)")
+
+    return connection
+
+
+def offer_id(file_name):
+    """Gets the key of an offer from the name of its file.
+    The same listing id can be saved under several states, so the state is kept in the key
+    and every row of data.csv gets its own offer.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the file as written in the log, state/listing_id.html.
+
+    Returns
+    -------
+    str
+        The state and the listing id, like Jalisco/123456.
+
+    """
+
+    return file_name.replace(".html", "")
+
+
+def insert_rows(connection, items):
+    """Inserts or replaces offers, so loading the same listings again is safe.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    items : iterable
+        Tuples of (offer id, row), the rows in the same order as COLUMNS.
+        See offer_id() for the key of the offers parsed by step2.py.
+
+    """
+
+    placeholders = ", ".join(["?"] * (len(COLUMNS) + 1))
+
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO offers VALUES ({})".format(placeholders),
+                               ((listing_id, *row[:-1], row[-1] or None)
+                                for listing_id, row in items))
+
+
+def convert_row(values):
+    """Converts the values of a .csv row from strings to the column types.
+
+    Parameters
+    ----------
+    values : list
+        The values in the same order as COLUMNS, duplicate_of can be missing.
+
+    Returns
+    -------
+    tuple
+        The converted values, with an empty duplicate_of if it was missing.
+
+    """
+
+    converted = tuple(CONVERTERS[COLUMN_TYPES[column]](value)
+                      for column, value in zip(COLUMNS, values))
+
+    return converted + ("",) * (len(COLUMNS) - len(converted))
+
+
+def read_rows(csv_file=SAMPLE_FILE):
+    """Reads the rows of a .csv file produced by step2, see convert_row().
+
+    Parameters
+    ----------
+    csv_file : str
+        The path of the .csv file, the shipped dataset by default.
+
+    Returns
+    -------
+    generator
+        The rows in the same order as COLUMNS, converted to their types.
+
+    """
+
+    with open(csv_file, "r", encoding="utf-8", newline="") as temp_file:
+
+        reader = csv.reader(temp_file)
+        next(reader)
+
+        for values in reader:
+            yield convert_row(values)
+
+
+def simulated_month(month):
+    """Gets the year and month used for a simulated month of listings, see simulate_history().
+
+    Parameters
+    ----------
+    month : int
+        The number of the month, 0 is January 2020.
+
+    Returns
+    -------
+    str
+        The year and month, like 2020-01.
+
+    """
+
+    return "{}-{:02d}".format(2020 + month // 12, month % 12 + 1)
+
+
+def simulate_history(rows, months):
+    """Repeats the rows once for each month with the dates moved to that month.
+    The benchmarks use it to get a history of several months from a single one.
+
+    Parameters
+    ----------
+    rows : list
+        The rows in the same order as COLUMNS.
+
+    months : int
+        The number of months.
+
+    Returns
+    -------
+    generator
+        The rows of every month, in the same order as the given rows.
+
+    """
+
+    for month in range(months):
+
+        prefix = simulated_month(month)
+
+        # The 28th is the last day every month has.
+        for row in rows:
+            yield ("{}-{:02d}".format(prefix, min(int(row[0][8:10]), 28)),) + row[1:]
+
+
+def build_filters(start_date=None, end_date=None, state=None, municipality=None,
+                  education_level=None, min_salary=None, max_salary=None,
+                  include_duplicates=False):
+    """Builds the WHERE clause for the query functions.
+
+    Parameters
+    ----------
+    start_date : str
+        The first date to include, in ISO format.
+
+    end_date : str
+        The last date to include, in ISO format.
+
+    state : str
+        Only offers from this state.
+
+    municipality : str
+        Only offers from this municipality.
+
+    education_level : str
+        Only offers that require this education level.
+
+    min_salary : int
+        The minimum monthly salary.
+
+    max_salary : int
+        The maximum monthly salary.
+
+    include_duplicates : bool
+        Whether to include the offers flagged as reposts.
+
+    Returns
+    -------
+    tuple
+        The WHERE clause and its parameters.
+
+    """
+
+    conditions = list()
+    parameters = list()
+
+    for condition, value in [("isodate >= ?", start_date),
+                             ("isodate <= ?", end_date),
+                             ("state = ?", state),
+                             ("municipality = ?", municipality),
+                             ("education_level = ?", education_level),
+                             ("salary >= ?", min_salary),
+                             ("salary <= ?", max_salary)]:
+
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+
+    if not include_duplicates:
+        conditions.append("duplicate_of IS NULL")
+
+    if not conditions:
+        return "", parameters
+
+    return "WHERE " + " AND ".join(conditions), parameters
+
+
+def check_column(column):
+    """Makes sure a column can be used in a GROUP BY, since it is added to the SQL as is.
+
+    Parameters
+    ----------
+    column : str
+        The column name.
+
+    """
+
+    if column not in GROUP_COLUMNS:
+        raise ValueError("Can't group by: {}".format(column))
+
+
+def query(connection, columns=None, as_frame=True, **filters):
+    """Gets the offers that match the filters.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    columns : list
+        The columns to return, all of them by default.
+
+    as_frame : bool
+        Whether to return a DataFrame or an iterator of tuples.
+
+    filters : object
+        The filters accepted by build_filters().
+
+    Returns
+    -------
+    pandas.DataFrame or iterator
+        The matching offers.
+
+    """
+
+    columns = columns or COLUMNS
+
+    for column in columns:
+        if column not in COLUMN_TYPES:
+            raise ValueError("Unknown column: {}".format(column))
+
+    where, parameters = build_filters(**filters)
+    sql = "SELECT {} FROM offers {}".format(", ".join(columns), where)
+
+    if not as_frame:
+        return connection.execute(sql, parameters)
+
+    # pandas is only needed when a DataFrame is requested.
+    import pandas as pd
+
+    parse_dates = ["isodate"] if "isodate" in columns else None
+
+    return pd.read_sql_query(sql, connection, params=parameters, parse_dates=parse_dates)
+
+
+def group_counts(connection, by, **filters):
+    """Counts the offers in each group.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    by : str
+        The column to group by, see GROUP_COLUMNS.
+
+    filters : object
+        The filters accepted by build_filters().
+
+    Returns
+    -------
+    list
+        Tuples of (group, count) sorted by count in descending order.
+
+    """
+
+    check_column(by)
+    where, parameters = build_filters(**filters)
+
+    return connection.execute(
+        "SELECT {0}, COUNT(*) AS total FROM offers {1} GROUP BY {0} ORDER BY total DESC".format(
+            by, where), parameters).fetchall()
+
+
+def group_medians(connection, by=None, **filters):
+    """Gets the median salary of each group, or of all the matching offers.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    by : str
+        The column to group by, see GROUP_COLUMNS. None for a single median.
+
+    filters : object
+        The filters accepted by build_filters().
+
+    Returns
+    -------
+    list or float
+        Tuples of (group, median) sorted by median in descending order,
+        or the median when by is None.
+
+    """
+
+    where, parameters = build_filters(**filters)
+
+    # SQLite has no median, the salaries come sorted so each group is read once.
+    if by is None:
+        salaries = [salary for salary, in connection.execute(
+            "SELECT salary FROM offers {} ORDER BY salary".format(where), parameters)]
+
+        return calculate_median(salaries)
+
+    check_column(by)
+    medians = list()
+    current_group = None
+    salaries = list()
+
+    for group, salary in connection.execute(
+            "SELECT {0}, salary FROM offers {1} ORDER BY {0}, salary".format(by, where), parameters):
+
+        if group != current_group and salaries:
+            medians.append((current_group, calculate_median(salaries)))
+            salaries = list()
+
+        current_group = group
+        salaries.append(salary)
+
+    if salaries:
+        medians.append((current_group, calculate_median(salaries)))
+
+    return sorted(medians, key=lambda item: item[1], reverse=True)
+
+
+def calculate_median(values):
+    """Gets the median of a sorted list, the same way pandas does.
+
+    Parameters
+    ----------
+    values : list
+        The sorted values.
+
+    Returns
+    -------
+    float
+        The median, None if the list is empty.
+
+    """
+
+    if not values:
+        return None
+
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return float(values[middle])
+
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def top_titles(connection, n=10, **filters):
+    """Gets the most frequent offer titles.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    n : int
+        The number of titles.
+
+    filters : object
+        The filters accepted by build_filters().
+
+    Returns
+    -------
+    list
+        Tuples of (title, count).
+
+    """
+
+    return group_counts(connection, "offer", **filters)[:n]
+
+
+def load_csv(connection, csv_file="data.csv"):
+    """Loads an existing .csv file produced by step2 into the database.
+    The .csv file has no listing ids, each row gets csv:<absolute path>:<row number> instead.
+    The same offer loaded by step2.py --database and from the .csv file would be counted
+    twice and the medians and counts would be wrong, so only an empty database or one
+    loaded from the same file is accepted.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection.
+
+    csv_file : str
+        The path of the .csv file.
+
+    """
+
+    prefix = "csv:{}:".format(os.path.abspath(csv_file))
+
+    other = connection.execute(
+        "SELECT listing_id FROM offers WHERE substr(listing_id, 1, ?) != ? LIMIT 1",
+        (len(prefix), prefix)).fetchone()
+
+    if other is not None:
+        raise ValueError("The database has offers that don't come from {}: {}".format(
+            csv_file, other[0]))
+
+    insert_rows(connection, ((prefix + str(number), row)
+                             for number, row in enumerate(read_rows(csv_file))))
+
+
+def benchmark(csv_file=SAMPLE_FILE, scales=(10, 100)):
+    """Compares the latency of a filtered median between the database and loading the .csv file.
+
+    Parameters
+    ----------
+    csv_file : str
+        The .csv file used as seed, it is repeated to reach each scale.
+
+    scales : tuple
+        How many times the seed file is repeated.
+
+    """
+
+    import pandas as pd
+
+    seed_rows = list(read_rows(csv_file))
+
+    filters = {"state": "Nuevo León", "education_level": "Licenciatura",
+               "start_date": "2020-08-24", "end_date": "2020-08-31"}
+
+    print("| Rows | CSV load + filter (s) | SQLite median (s) | SQLite count by state (s) |")
+    print("|---:|---:|---:|---:|")
+
+    for scale in scales:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            scaled_csv = os.path.join(folder, "data.csv")
+
+            with open(scaled_csv, "w", encoding="utf-8", newline="") as temp_file:
+                writer = csv.writer(temp_file)
+                writer.writerow(COLUMNS)
+
+                for _ in range(scale):
+                    writer.writerows(seed_rows)
+
+            connection = connect(os.path.join(folder, "jobs.db"))
+            load_csv(connection, scaled_csv)
+
+            start_time = time.perf_counter()
+            df = pd.read_csv(scaled_csv, parse_dates=["isodate"])
+            df = df[(df["state"] == filters["state"]) &
+                    (df["education_level"] == filters["education_level"]) &
+                    (df["isodate"] >= filters["start_date"]) &
+                    (df["isodate"] <= filters["end_date"])]
+            csv_median = df["salary"].median()
+            csv_seconds = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            sqlite_median = group_medians(connection, **filters)
+            sqlite_seconds = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            group_counts(connection, "state", start_date=filters["start_date"])
+            counts_seconds = time.perf_counter() - start_time
+
+            connection.close()
+
+        assert csv_median == sqlite_median
+
+        print("| {:,} | {:.3f} | {:.4f} | {:.4f} |".format(
+            len(seed_rows) * scale, csv_seconds, sqlite_seconds, counts_seconds))
+
+
+if __name__ == "__main__":
+
+    benchmark()
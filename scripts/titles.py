@@ -0,0 +1,522 @@
+"""
+This module keeps an inverted index of the words in the offer titles, so questions like
+how many offers mention ventas in each state don't need a substring scan of every row.
+
+Each word points to the ids of the rows that contain it, the row id is the position of
+the row in data.csv. The ids are saved as the differences between consecutive ids,
+each one encoded as a variable length integer, so frequent words take about a byte per row.
+"""
+
+import base64
+import bisect
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+
+import columns
+import store
+
+
+TITLES_FILE = "./titles.json"
+
+# The row columns kept by the index, to count the matches by state and title.
+ROW_COLUMNS = ["offer", "state", "duplicate_of"]
+
+# Positions of the row columns in a step2 row.
+ROW_POSITIONS = {"offer": 1, "state": 15, "duplicate_of": 20}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def create_index():
+    """Creates an empty index.
+
+    Returns
+    -------
+    dict
+        The postings of each token, the last row id of each token and the row columns.
+
+    """
+
+    return {"postings": dict(), "last_ids": dict(),
+            "rows": columns.ColumnBuffer(ROW_COLUMNS, ["TEXT"] * len(ROW_COLUMNS)),
+            "sorted_tokens": None}
+
+
+def load_index(titles_file=TITLES_FILE):
+    """Loads the index from disk, an empty index is returned if the file doesn't exist.
+
+    Parameters
+    ----------
+    titles_file : str
+        The path of the index file.
+
+    Returns
+    -------
+    dict
+        The index.
+
+    """
+
+    index = create_index()
+
+    if not os.path.exists(titles_file):
+        return index
+
+    with open(titles_file, "r", encoding="utf-8") as temp_file:
+        saved = json.load(temp_file)
+
+    for token, (postings, last_id) in saved["postings"].items():
+        index["postings"][token] = bytearray(base64.b64decode(postings))
+        index["last_ids"][token] = last_id
+
+    # The rows are saved as the distinct values and the codes of each column.
+    for column, values, codes in zip(ROW_COLUMNS, saved["values"], saved["codes"]):
+        index["rows"].extend_encoded(column, values, codes)
+
+    return index
+
+
+def save_index(index, titles_file=TITLES_FILE):
+    """Saves the index to disk.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    titles_file : str
+        The path of the index file.
+
+    """
+
+    rows = index["rows"]
+
+    saved = {"postings": {token: [base64.b64encode(postings).decode("ascii"),
+                                  index["last_ids"][token]]
+                          for token, postings in index["postings"].items()},
+             "values": [rows.distinct_values(column) for column in ROW_COLUMNS],
+             "codes": [rows.encoded(column).tolist() for column in ROW_COLUMNS]}
+
+    with open(titles_file, "w", encoding="utf-8") as temp_file:
+        json.dump(saved, temp_file, ensure_ascii=False)
+
+
+def tokenize(text):
+    """Splits a title or a query into lowercase words without accents.
+
+    Parameters
+    ----------
+    text : str
+        The text to be split.
+
+    Returns
+    -------
+    list
+        The words.
+
+    """
+
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+
+    return TOKEN_PATTERN.findall(text)
+
+
+def encode_varint(value, postings):
+    """Appends a non negative integer to the postings, 7 bits per byte.
+
+    Parameters
+    ----------
+    value : int
+        The integer to be encoded.
+
+    postings : bytearray
+        The encoded postings.
+
+    """
+
+    while value >= 0x80:
+        postings.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    postings.append(value)
+
+
+def decode_postings(postings):
+    """Decodes the row ids of a postings list.
+
+    Parameters
+    ----------
+    postings : bytearray
+        The encoded postings.
+
+    Returns
+    -------
+    list
+        The row ids in ascending order.
+
+    """
+
+    row_ids = list()
+    row_id = 0
+    value = 0
+    shift = 0
+
+    for byte in postings:
+
+        value |= (byte & 0x7F) << shift
+        shift += 7
+
+        if byte < 0x80:
+            row_id += value
+            row_ids.append(row_id)
+            value = 0
+            shift = 0
+
+    return row_ids
+
+
+def add_rows(index, rows):
+    """Adds new rows to the index, they get the next row ids.
+    Flagged reposts keep their row id but their words are not indexed.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    rows : iterable
+        Rows in the same order as step2.COLUMNS.
+
+    """
+
+    postings = index["postings"]
+    last_ids = index["last_ids"]
+    buffer = index["rows"]
+
+    for row in rows:
+
+        row_id = len(buffer)
+        buffer.append(tuple(row[ROW_POSITIONS[column]] for column in ROW_COLUMNS))
+
+        if row[ROW_POSITIONS["duplicate_of"]]:
+            continue
+
+        # dict.fromkeys() drops repeated words but keeps their order, so the saved file
+        # doesn't depend on the hash seed.
+        for token in dict.fromkeys(tokenize(row[ROW_POSITIONS["offer"]])):
+
+            if token not in postings:
+                postings[token] = bytearray()
+                last_ids[token] = 0
+
+            # The first id is stored as is, since the last id starts at 0.
+            encode_varint(row_id - last_ids[token], postings[token])
+            last_ids[token] = row_id
+
+    # New tokens invalidate the sorted list used by prefix queries.
+    index["sorted_tokens"] = None
+
+
+def expand_term(index, term):
+    """Gets the tokens of a query term, a term ending with * matches every token with that prefix.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    term : str
+        A word, optionally ending with *.
+
+    Returns
+    -------
+    list
+        The matching tokens that are in the index.
+
+    """
+
+    if not term.endswith("*"):
+        return [token for token in tokenize(term) if token in index["postings"]]
+
+    prefix = "".join(tokenize(term[:-1]))
+
+    if index["sorted_tokens"] is None:
+        index["sorted_tokens"] = sorted(index["postings"])
+
+    sorted_tokens = index["sorted_tokens"]
+    tokens = list()
+
+    for position in range(bisect.bisect_left(sorted_tokens, prefix), len(sorted_tokens)):
+
+        if not sorted_tokens[position].startswith(prefix):
+            break
+
+        tokens.append(sorted_tokens[position])
+
+    return tokens
+
+
+def search(index, terms, operator="and"):
+    """Gets the rows whose title matches the query terms.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    terms : list
+        Words, a word ending with * matches every word with that prefix.
+
+    operator : str
+        and, every term must match, or or, any term can match.
+
+    Returns
+    -------
+    list
+        The matching row ids in ascending order.
+
+    """
+
+    if operator not in ["and", "or"]:
+        raise ValueError("Unknown operator: {}".format(operator))
+
+    # A prefix term matches if any of its tokens does.
+    term_ids = [set().union(*(decode_postings(index["postings"][token])
+                             for token in expand_term(index, term)))
+                for term in terms]
+
+    if not term_ids:
+        return list()
+
+    if operator == "or":
+        return sorted(set().union(*term_ids))
+
+    # Starting with the shortest list keeps the intersections small.
+    term_ids.sort(key=len)
+    matches = term_ids[0]
+
+    for row_ids in term_ids[1:]:
+        matches = matches.intersection(row_ids)
+
+    return sorted(matches)
+
+
+def counts_by_state(index, row_ids):
+    """Counts the matching rows in each state.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    row_ids : list
+        The row ids returned by search().
+
+    Returns
+    -------
+    collections.Counter
+        The number of rows for each state.
+
+    """
+
+    rows = index["rows"]
+    states = rows.distinct_values("state")
+    codes = rows.encoded("state")
+
+    return Counter({states[code]: count
+                    for code, count in Counter(codes[row_id] for row_id in row_ids).items()})
+
+
+def title_counts(index, state=None):
+    """Counts the rows of each distinct title, reposts are left out.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    state : str
+        Only count the rows of this state, all of them by default.
+
+    Returns
+    -------
+    collections.Counter
+        The number of rows for each title code.
+
+    """
+
+    rows = index["rows"]
+    title_codes = rows.encoded("offer")
+    state_codes = rows.encoded("state")
+    duplicate_codes = rows.encoded("duplicate_of")
+
+    # The code of the empty duplicate_of value, every row that isn't a repost has it.
+    original_code = rows.code("duplicate_of", "")
+
+    if state is None:
+        return Counter(title_code for title_code, duplicate_code in zip(title_codes, duplicate_codes)
+                       if duplicate_code == original_code)
+
+    state_code = rows.code("state", state)
+
+    return Counter(title_code for title_code, row_state, duplicate_code
+                   in zip(title_codes, state_codes, duplicate_codes)
+                   if row_state == state_code and duplicate_code == original_code)
+
+
+def top_titles(index, k=10, state=None):
+    """Gets the most frequent titles.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    k : int
+        The number of titles.
+
+    state : str
+        Only count the rows of this state, all of them by default.
+
+    Returns
+    -------
+    list
+        Tuples of (title, count).
+
+    """
+
+    titles = index["rows"].distinct_values("offer")
+
+    return [(titles[code], count) for code, count in title_counts(index, state).most_common(k)]
+
+
+def top_tokens(index, k=10, state=None):
+    """Gets the most frequent words in the titles.
+
+    Parameters
+    ----------
+    index : dict
+        The index.
+
+    k : int
+        The number of words.
+
+    state : str
+        Only count the rows of this state, all of them by default.
+
+    Returns
+    -------
+    list
+        Tuples of (word, count).
+
+    """
+
+    titles = index["rows"].distinct_values("offer")
+    tokens = Counter()
+
+    # Each distinct title is split once and its words weighted by the title count.
+    for code, count in title_counts(index, state).items():
+        for token in set(tokenize(titles[code])):
+            tokens[token] += count
+
+    return tokens.most_common(k)
+
+
+def build_from_csv(csv_file="data.csv"):
+    """Builds an index from an existing .csv file produced by step2.
+
+    Parameters
+    ----------
+    csv_file : str
+        The path of the .csv file.
+
+    Returns
+    -------
+    dict
+        The index.
+
+    """
+
+    index = create_index()
+    add_rows(index, store.read_rows(csv_file))
+
+    return index
+
+
+def benchmark(csv_file=store.SAMPLE_FILE, scale=10):
+    """Compares the index against str.contains() over a DataFrame.
+
+    Parameters
+    ----------
+    csv_file : str
+        The rows to be searched, they are repeated scale times.
+
+    scale : int
+        How many copies of the rows are indexed.
+
+    """
+
+    import pandas as pd
+
+    rows = list(store.read_rows(csv_file)) * scale
+
+    start_time = time.perf_counter()
+    index = create_index()
+    add_rows(index, rows)
+    build_seconds = time.perf_counter() - start_time
+
+    df = pd.DataFrame(rows, columns=store.COLUMNS)
+
+    # The titles were cleaned by step2, so the pandas patterns need no accents.
+    queries = [
+        ("ventas", ["ventas"], "and", r"\bventas\b"),
+        ("ejecutivo AND ventas", ["ejecutivo", "ventas"], "and", None),
+        ("chofer OR operador", ["chofer", "operador"], "or", r"\b(?:chofer|operador)\b"),
+        ("vend*", ["vend*"], "and", r"\bvend")
+    ]
+
+    print("Rows: {:,}, index built in {:.2f} s, {:,} tokens, {:,} bytes of postings".format(
+        len(rows), build_seconds, len(index["postings"]),
+        sum(len(postings) for postings in index["postings"].values())))
+    print("| Query | Index matches | Index + counts by state (ms) | str.contains matches "
+          "| str.contains + groupby (ms) |")
+    print("|---|---:|---:|---:|---:|")
+
+    offers = df["offer"].str.lower()
+
+    for name, terms, operator, pattern in queries:
+
+        start_time = time.perf_counter()
+        row_ids = search(index, terms, operator)
+        counts_by_state(index, row_ids)
+        index_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+
+        if pattern is None:
+            mask = offers.str.contains(r"\bejecutivo\b") & offers.str.contains(r"\bventas\b")
+        else:
+            mask = offers.str.contains(pattern)
+
+        pandas_counts = df[mask].groupby("state").size()
+        pandas_seconds = time.perf_counter() - start_time
+
+        # The counts can differ by a few rows, the index also ignores accents the cleaning missed.
+        print("| {} | {:,} | {:.1f} | {:,} | {:.1f} |".format(
+            name, len(row_ids), index_seconds * 1000, pandas_counts.sum(), pandas_seconds * 1000))
+
+    start_time = time.perf_counter()
+    top_tokens(index, 10, state="Jalisco")
+    top_titles(index, 10, state="Jalisco")
+    print("Top 10 titles and words in Jalisco: {:.1f} ms".format(
+        (time.perf_counter() - start_time) * 1000))
+
+
+if __name__ == "__main__":
+
+    benchmark()